@@ -19,6 +19,11 @@ actions are:
    mount: mount folder for current device.
    unmount: unmount folder for current device.
 
+   pin: keep files of given folder available offline.
+   unpin: stop keeping files of given folder available offline.
+   pin_status: display pinned folders and their download progress.
+   upload_status: display files saved locally and waiting for upload.
+
    display_config: display configuration for remote cozy.
    kill_running_replications: ask to database to stop synchronization.
 '''
@@ -34,6 +39,8 @@ def main(argv=sys.argv):
                         help='URL of remote Cozy to sync')
     parser.add_argument('-n', '--name',
                         help='Name of the device on which action occurs')
+    parser.add_argument('folder', nargs='?',
+                        help='Folder to pin or unpin')
 
     args = parser.parse_args()
 
@@ -72,6 +79,24 @@ def main(argv=sys.argv):
         password = retrieve_user_password()
         actions.reset(password)
 
+    elif args.action == 'pin':
+        try:
+            actions.pin_folder(args.name, args.folder)
+        except Exception, e:
+            print e
+
+    elif args.action == 'unpin':
+        try:
+            actions.unpin_folder(args.name, args.folder)
+        except Exception, e:
+            print e
+
+    elif args.action == 'pin_status':
+        actions.display_pins(args.name)
+
+    elif args.action == 'upload_status':
+        actions.display_uploads(args.name)
+
     elif args.action == 'display_config':
         actions.display_config()
 
@@ -3,11 +3,15 @@ import requests
 import json
 import sys
 
+import os
+
 import couchmount
 import replication
 import local_config
 import remote
 import dbutils
+import pins
+import writeback
 
 from couchdb import Server
 
@@ -209,6 +213,82 @@ def unmount_folder(name, path=None):
     couchmount.unmount(path)
 
 
+def pin_folder(name, path):
+    '''
+    Mark folder *path* of given device as always available offline. Its
+    files are downloaded by the mounted device.
+    '''
+    path = _get_device_path(name, path)
+    device_pins = local_config.get_pins(name)
+    device_pins.append(path)
+    local_config.set_pins(name, device_pins)
+    print 'Folder %s pinned, its files will be kept locally.' % path
+
+
+def unpin_folder(name, path):
+    '''
+    Stop keeping folder *path* of given device available offline.
+    '''
+    path = _get_device_path(name, path)
+    device_pins = local_config.get_pins(name)
+    if path in device_pins:
+        device_pins.remove(path)
+        local_config.set_pins(name, device_pins)
+        print 'Folder %s unpinned.' % path
+    else:
+        print 'Folder %s is not pinned.' % path
+
+
+def display_pins(name):
+    '''
+    Display pinned folders of given device and their download progress,
+    as reported by the mounted device.
+    '''
+    status = pins.read_status(name) or {'pins': {}}
+    device_pins = local_config.get_pins(name)
+    if len(device_pins) == 0:
+        print 'No folder pinned for %s.' % name
+
+    for path in device_pins:
+        pin_status = status['pins'].get(path)
+        if pin_status is None:
+            print '%s: waiting for mount' % path
+        else:
+            print '%s: %d/%d files, %d/%d bytes available offline' % (
+                path,
+                pin_status['cached_files'], pin_status['files'],
+                pin_status['cached_bytes'], pin_status['bytes'])
+
+
+def display_uploads(name):
+    '''
+    Display files of given device saved locally and waiting for upload.
+    '''
+    status = writeback.read_status(
+        local_config.get_device_folder(name, 'writeback'))
+    if status['depth'] == 0:
+        print 'No file waiting for upload for %s.' % name
+    else:
+        print '%d files (%d bytes) waiting for upload, oldest saved %ds ago' \
+            % (status['depth'], status['bytes'], status['age'])
+
+
+def _get_device_path(name, path):
+    '''
+    Return path of given folder in the device. Paths located in the mount
+    folder of the device are converted.
+    '''
+    if path is None:
+        raise ProcessedException('A folder path is required')
+    (url, mount_path) = local_config.get_config(name)
+    mount_path = os.path.abspath(os.path.expanduser(mount_path))
+    local_path = os.path.abspath(path)
+    if local_path == mount_path or \
+            local_path.startswith(mount_path + os.sep):
+        path = local_path[len(mount_path):]
+    return pins.normalize(path)
+
+
 def display_config():
     '''
     Display config file in a human readable way.
@@ -0,0 +1,486 @@
+import os
+import json
+import mmap
+import time
+import urllib
+import threading
+import logging
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+TOUCH_STEP = 64
+
+
+class CacheEntry(object):
+    '''
+    Cached content of a given binary revision: file length, indexes of
+    the blocks already stored on disk and access statistics.
+    '''
+    __slots__ = ('binary_id', 'rev', 'length', 'blocks', 'size', 'atime',
+                 'hits')
+
+    def __init__(self, binary_id, rev, length=None, blocks=None, hits=0):
+        self.binary_id = binary_id
+        self.rev = rev
+        self.length = length
+        self.blocks = set(blocks or [])
+        self.size = 0
+        self.atime = time.time()
+        self.hits = hits
+
+
+class LRUPolicy(object):
+    '''
+    Evict entries unused for the longest time first. Idle time is weighted
+    by entry size, so a big file is evicted before a small one of the same
+    age.
+    '''
+
+    def score(self, entry, now):
+        return (now - entry.atime + 1) * entry.size
+
+
+class LFUPolicy(object):
+    '''
+    Evict entries with the fewest hits per cached byte first.
+    '''
+
+    def score(self, entry, now):
+        return entry.size / float(entry.hits + 1)
+
+
+POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+}
+
+
+class BlockCache(object):
+    '''
+    Persistent, size-bounded cache of binary attachments. Attachments are
+    split in blocks of *block_size* bytes that are written in a sparse data
+    file per binary. Entries are keyed by binary id and revision: when the
+    revision of a binary changes, its cached blocks are dropped.
+
+    When the cache grows over *max_size* bytes, entries with the highest
+    score of the eviction *policy* (lru or lfu) are removed. Binaries of
+    open files and pinned binaries are never evicted.
+    '''
+
+    def __init__(self, folder, max_size=DEFAULT_CACHE_SIZE,
+                 block_size=BLOCK_SIZE, policy='lru'):
+        self.folder = folder
+        self.max_size = max_size
+        self.block_size = block_size
+        self.policy = POLICIES[policy]()
+        self.entries = {}
+        self.size = 0
+        self.opened = {}
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.lock = threading.RLock()
+
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._load()
+
+    def read(self, binary_id, rev, offset, size):
+        '''
+        Return *size* bytes of given binary revision starting at *offset*.
+        Returns None if one of the required blocks is not cached. The data
+        file is opened under the lock: once open, it keeps the content of
+        this revision even if the entry is invalidated meanwhile.
+        '''
+        with self.lock:
+            entry = self._get_entry(binary_id, rev)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry.length is not None:
+                if offset >= entry.length:
+                    return ''
+                size = min(size, entry.length - offset)
+
+            for index in self._block_range(offset, size):
+                if index not in entry.blocks:
+                    self.misses += 1
+                    return None
+
+            self._touch(entry)
+            try:
+                data_file = open(self._data_path(binary_id), 'rb')
+            except IOError:
+                return None
+
+        with data_file:
+            data_file.seek(offset)
+            return data_file.read(size)
+
+    def contains(self, binary_id, rev, offset, size):
+        '''
+        Return True if given part of the binary revision is cached.
+        '''
+        with self.lock:
+            entry = self._get_entry(binary_id, rev)
+            if entry is None:
+                return False
+            if entry.length is not None:
+                if offset >= entry.length:
+                    return True
+                size = min(size, entry.length - offset)
+            for index in self._block_range(offset, size):
+                if index not in entry.blocks:
+                    return False
+            return True
+
+    def map(self, binary_id, rev):
+        '''
+        Return a read-only memory map of given binary revision if all its
+        blocks are cached, None otherwise.
+        '''
+        with self.lock:
+            entry = self._get_entry(binary_id, rev)
+            if entry is None or not entry.length:
+                return None
+            if len(entry.blocks) < len(self._block_range(0, entry.length)):
+                return None
+            self._touch(entry)
+
+            try:
+                with open(self._data_path(binary_id), 'rb') as data_file:
+                    return mmap.mmap(data_file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+            except EnvironmentError:
+                return None
+
+    def touch(self, binary_id, rev, count=1):
+        '''
+        Record *count* reads of given binary revision served without the
+        cache (from a memory map).
+        '''
+        with self.lock:
+            entry = self.entries.get(binary_id)
+            if entry is not None and entry.rev == rev:
+                self._touch(entry, count)
+                self._save_meta(entry)
+
+    def handle(self, binary_id, rev):
+        '''
+        Return a handle on cached content of given binary revision. The
+        binary is protected from eviction until the handle is closed.
+        '''
+        with self.lock:
+            self.opened[binary_id] = self.opened.get(binary_id, 0) + 1
+        return CacheHandle(self, binary_id, rev)
+
+    def _close_handle(self, binary_id):
+        with self.lock:
+            count = self.opened.get(binary_id, 0) - 1
+            if count > 0:
+                self.opened[binary_id] = count
+            else:
+                self.opened.pop(binary_id, None)
+
+    def pin(self, binary_id):
+        '''
+        Protect given binary from eviction.
+        '''
+        with self.lock:
+            self.pinned.add(binary_id)
+
+    def unpin(self, binary_id):
+        with self.lock:
+            self.pinned.discard(binary_id)
+
+    def set_pinned(self, binary_ids):
+        '''
+        Replace the set of binaries protected from eviction.
+        '''
+        with self.lock:
+            self.pinned = set(binary_ids)
+
+    def stats(self):
+        '''
+        Return cache size and counters.
+        '''
+        with self.lock:
+            return {
+                'size': self.size,
+                'max_size': self.max_size,
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+            }
+
+    def store(self, binary_id, rev, offset, data, length=None):
+        '''
+        Write *data* located at *offset* in given binary revision to the
+        cache. Only blocks fully covered by *data* (or ending at the end of
+        the file when *length* is known) are marked as cached.
+        '''
+        with self.lock:
+            self._store(binary_id, rev, offset, data, length)
+
+    def _store(self, binary_id, rev, offset, data, length):
+        entry = self._get_entry(binary_id, rev)
+        if entry is None:
+            entry = CacheEntry(binary_id, rev)
+            self.entries[binary_id] = entry
+        if length is not None:
+            entry.length = length
+
+        end = offset + len(data)
+        first = (offset + self.block_size - 1) // self.block_size
+        stored = []
+        index = first
+        while True:
+            block_start = index * self.block_size
+            block_end = block_start + self.block_size
+            if entry.length is not None:
+                block_end = min(block_end, entry.length)
+            if block_start >= end or block_end > end:
+                break
+            stored.append(index)
+            index += 1
+
+        new_blocks = [index for index in stored if index not in entry.blocks]
+        if len(new_blocks) == 0:
+            self._save_meta(entry)
+            return
+
+        data_path = self._data_path(binary_id)
+        mode = 'r+b' if os.path.isfile(data_path) else 'wb'
+        with open(data_path, mode) as data_file:
+            for index in new_blocks:
+                block_start = index * self.block_size
+                chunk = data[block_start - offset:
+                             block_start - offset + self.block_size]
+                data_file.seek(block_start)
+                data_file.write(chunk)
+                entry.blocks.add(index)
+                entry.size += len(chunk)
+                self.size += len(chunk)
+
+        entry.atime = time.time()
+        self._save_meta(entry)
+        self._evict(keep=binary_id)
+
+    def invalidate(self, binary_id):
+        '''
+        Drop every cached block of given binary.
+        '''
+        with self.lock:
+            entry = self.entries.pop(binary_id, None)
+            if entry is not None:
+                self.size -= entry.size
+            for path in (self._data_path(binary_id),
+                         self._meta_path(binary_id)):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def _get_entry(self, binary_id, rev):
+        '''
+        Return entry for given binary revision. Entry of an outdated revision
+        is removed from the cache.
+        '''
+        entry = self.entries.get(binary_id)
+        if entry is not None and entry.rev != rev:
+            logger.info('[Cache] Binary %s changed, cache dropped' % binary_id)
+            self.invalidate(binary_id)
+            entry = None
+        return entry
+
+    def _block_range(self, offset, size):
+        '''
+        Return indexes of blocks covering given byte range.
+        '''
+        if size <= 0:
+            return []
+        first = offset // self.block_size
+        last = (offset + size - 1) // self.block_size
+        return range(first, last + 1)
+
+    def _touch(self, entry, count=1):
+        entry.atime = time.time()
+        entry.hits += count
+        self.hits += count
+
+    def _evict(self, keep=None):
+        '''
+        Remove entries with the highest eviction score until cache size
+        fits in the allowed size.
+        '''
+        if self.size <= self.max_size:
+            return
+
+        now = time.time()
+        entries = sorted(self.entries.values(),
+                         key=lambda entry: self.policy.score(entry, now),
+                         reverse=True)
+        for entry in entries:
+            if self.size <= self.max_size:
+                break
+            if entry.binary_id == keep or \
+                    entry.binary_id in self.opened or \
+                    entry.binary_id in self.pinned:
+                continue
+            logger.info('[Cache] Evict binary %s' % entry.binary_id)
+            self.evictions += 1
+            self.evicted_bytes += entry.size
+            self.invalidate(entry.binary_id)
+
+        if self.size > self.max_size:
+            logger.warn('[Cache] %d bytes used over quota, open and pinned '
+                        'files cannot be evicted' %
+                        (self.size - self.max_size))
+
+    def _load(self):
+        '''
+        Rebuild entry list from metadata files stored in cache folder.
+        '''
+        for filename in os.listdir(self.folder):
+            if not filename.endswith('.meta'):
+                continue
+
+            binary_id = urllib.unquote(filename[:-len('.meta')])
+            try:
+                with open(os.path.join(self.folder, filename)) as meta_file:
+                    meta = json.load(meta_file)
+                entry = CacheEntry(binary_id, meta['rev'],
+                                   meta['length'], meta['blocks'],
+                                   meta.get('hits', 0))
+            except (IOError, ValueError, KeyError):
+                logger.warn('[Cache] Corrupted entry %s removed' % binary_id)
+                self.invalidate(binary_id)
+                continue
+
+            data_path = self._data_path(binary_id)
+            if not os.path.isfile(data_path):
+                self.invalidate(binary_id)
+                continue
+
+            for index in entry.blocks:
+                block_start = index * self.block_size
+                block_end = block_start + self.block_size
+                if entry.length is not None:
+                    block_end = min(block_end, entry.length)
+                entry.size += block_end - block_start
+            entry.atime = os.path.getmtime(data_path)
+            self.entries[binary_id] = entry
+            self.size += entry.size
+
+        logger.info('[Cache] %d entries loaded (%d bytes)' %
+                    (len(self.entries), self.size))
+
+    def _save_meta(self, entry):
+        '''
+        Persist entry metadata next to its data file.
+        '''
+        meta = {
+            'rev': entry.rev,
+            'length': entry.length,
+            'blocks': sorted(entry.blocks),
+            'hits': entry.hits,
+        }
+        with open(self._meta_path(entry.binary_id), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+    def _data_path(self, binary_id):
+        return os.path.join(self.folder,
+                            '%s.data' % urllib.quote(binary_id, safe=''))
+
+    def _meta_path(self, binary_id):
+        return os.path.join(self.folder,
+                            '%s.meta' % urllib.quote(binary_id, safe=''))
+
+
+class CacheHandle(object):
+    '''
+    Cached content of a binary revision, as seen by an open file. Once the
+    binary is fully cached, reads are served from a memory map of its data
+    file and return buffers instead of copies. Mapped reads are counted
+    and reported to the cache every TOUCH_STEP reads and on close.
+    '''
+    __slots__ = ('cache', 'binary_id', 'rev', 'mapped', 'reads', 'lock')
+
+    def __init__(self, cache, binary_id, rev):
+        self.cache = cache
+        self.binary_id = binary_id
+        self.rev = rev
+        self.mapped = None
+        self.reads = 0
+        self.lock = threading.Lock()
+
+    def read(self, offset, size):
+        mapped = self.mapped
+        if mapped is None:
+            mapped = self._map()
+        if mapped is not None:
+            count = 0
+            with self.lock:
+                self.reads += 1
+                if self.reads >= TOUCH_STEP:
+                    (count, self.reads) = (self.reads, 0)
+            if count > 0:
+                self.cache.touch(self.binary_id, self.rev, count)
+            return buffer(mapped, offset, size)
+        return self.cache.read(self.binary_id, self.rev, offset, size)
+
+    def contains(self, offset, size):
+        return self.cache.contains(self.binary_id, self.rev, offset, size)
+
+    def store(self, offset, data, length=None):
+        self.cache.store(self.binary_id, self.rev, offset, data, length)
+
+    def close(self):
+        '''
+        Release the memory map, if any, and eviction protection. The map is
+        not closed explicitly: buffers returned by pending reads may still
+        use it.
+        '''
+        with self.lock:
+            self.mapped = None
+            (count, self.reads) = (self.reads, 0)
+        if count > 0:
+            self.cache.touch(self.binary_id, self.rev, count)
+        self.cache._close_handle(self.binary_id)
+
+    def _map(self):
+        with self.lock:
+            if self.mapped is None:
+                self.mapped = self.cache.map(self.binary_id, self.rev)
+            return self.mapped
+
+
+def download(cache, fetch, binary_id, rev, size, stopped=None, wait=None):
+    '''
+    Download blocks of given binary revision missing from *cache*, one block
+    at a time with *fetch*. *wait* is called before each download, setting
+    the *stopped* event interrupts it.
+    '''
+    handle = cache.handle(binary_id, rev)
+    try:
+        offset = 0
+        while offset < size:
+            if stopped is not None and stopped.is_set():
+                return
+            if not handle.contains(offset, cache.block_size):
+                if wait is not None:
+                    wait()
+                if len(fetch(handle, offset, cache.block_size)) == 0:
+                    return
+            offset += cache.block_size
+    finally:
+        handle.close()
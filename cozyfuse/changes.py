@@ -0,0 +1,69 @@
+import threading
+import logging
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+POLL_TIMEOUT = 30000
+BATCH_SIZE = 500
+RETRY_DELAY = 5
+
+
+class ChangesFollower(threading.Thread):
+    '''
+    Background thread following the _changes feed of the local database
+    from a given sequence. Each change is passed to *callback*, then the
+    sequence reached is passed to *on_seq*.
+    '''
+
+    def __init__(self, db, since, callback, on_seq=None):
+        threading.Thread.__init__(self, name='changes-follower')
+        self.daemon = True
+        self.db = db
+        self.seq = since
+        self.callback = callback
+        self.on_seq = on_seq
+        self.stopped = threading.Event()
+
+    def run(self):
+        logger.info('[Changes] Following changes since %s' % self.seq)
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception('[Changes] Cannot read changes feed')
+                self.stopped.wait(RETRY_DELAY)
+
+    def poll(self):
+        '''
+        Wait for the next batch of changes and apply it.
+        '''
+        changes = self.db.changes(feed='longpoll',
+                                  since=self.seq,
+                                  include_docs=True,
+                                  timeout=POLL_TIMEOUT,
+                                  limit=BATCH_SIZE)
+
+        for line in changes.get('results', []):
+            if self.stopped.is_set():
+                return
+            try:
+                self.callback(line)
+            except Exception:
+                logger.exception(
+                    '[Changes] Cannot apply change of %s' % line.get('id'))
+            self.seq = line['seq']
+
+        self.seq = changes.get('last_seq', self.seq)
+        if self.on_seq is not None:
+            self.on_seq(self.seq)
+
+    def stop(self):
+        '''
+        Ask the thread to stop after the current poll.
+        '''
+        self.stopped.set()
+
@@ -13,16 +13,31 @@ import platform
 import errno
 import fuse
 import stat
+import time
 import subprocess
 import logging
 import datetime
-import calendar
+import threading
 
 import dbutils
 import local_config
+import staging
+from cache import BlockCache
+from changes import ChangesFollower
+from prefetch import Prefetcher, ReadAhead
+from inodes import InodeTable
+from metastore import MetaStore
+from pins import PinWorker
+from warmup import AccessLog, ForegroundGate, Warmer
+from writeback import WriteBackQueue, Uploader
+from pathindex import PathIndex, NegativeCache
+from couchdb.http import ResourceConflict, ResourceNotFound
 
 fuse.fuse_python_api = (0, 2)
 
+STATFS_BLOCK_SIZE = 4096
+STATFS_TTL = 10
+
 CONFIG_FOLDER = os.path.join(os.path.expanduser('~'), '.cozyfuse')
 HDLR = logging.FileHandler(os.path.join(CONFIG_FOLDER, 'cozyfuse.log'))
 HDLR.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
@@ -33,16 +48,6 @@ logger.setLevel(logging.INFO)
 #local_config.configure_logger(logger)
 
 
-def get_date(ctime):
-    ctime = ctime[0:24]
-    try:
-        date = datetime.datetime.strptime(ctime, "%a %b %d %H:%M:%S %Y")
-    except ValueError:
-        date = datetime.datetime.strptime(ctime, "%a %b %d %Y %H:%M:%S")
-    return calendar.timegm(date.utctimetuple())
-
-
-
 class CouchStat(fuse.Stat):
     '''
     Default file descriptor.
@@ -60,6 +65,176 @@ class CouchStat(fuse.Stat):
         self.st_ctime = 0
 
 
+class OpenFile(object):
+    '''
+    State shared by the handles opened on a same file: document and binary
+    ids resolved at open time, cache handle of the binary revision, staging
+    file once the file is written and number of open handles.
+    '''
+
+    def __init__(self, path, node, cache):
+        self.path = path
+        self.doc_id = node.doc_id
+        self.size = node.size
+        self.staged = None
+        self.refs = 0
+        self.released = False
+        self.deleted = False
+        self.lock = threading.Lock()
+        self.cache = None
+        self.set_binary(node.binary_id, node.binary_rev, cache)
+
+    def set_binary(self, binary_id, binary_rev, cache):
+        previous = self.cache
+        self.binary_id = binary_id
+        self.binary_rev = binary_rev
+        self.cache = cache.handle(binary_id, binary_rev)
+        if previous is not None:
+            previous.close()
+
+    def update(self, file_doc, cache):
+        '''
+        Track new size and binary revision of a saved file.
+        '''
+        self.size = file_doc.get('size', 0)
+        binary = file_doc['binary']['file']
+        self.set_binary(binary['id'], binary.get('rev'), cache)
+
+
+class CouchFile(object):
+    '''
+    File handle created by FUSE on open (and create). Reads and writes go
+    through the open file state, without resolving the path again. The file
+    system is bound to the class as its *fs* attribute.
+    '''
+    fs = None
+
+    def __init__(self, path, flags, *mode):
+        path = _normalize_path(path)
+        logger.info('open %s' % path)
+        try:
+            if len(mode) > 0:
+                node = self.fs._create_file(path)
+            else:
+                node = self.fs.lookup(path)
+        except Exception, e:
+            logger.exception(e)
+            raise IOError(errno.EIO, 'Cannot open %s' % path)
+
+        if node is None or node.is_folder():
+            logger.error('File not found %s' % path)
+            raise IOError(errno.ENOENT, 'File not found %s' % path)
+        self.open_file = self.fs.acquire_file(path, node)
+        self.fs.access_log.record(node.doc_id)
+
+        # Pages cached by the kernel are kept while the binary does not
+        # change. Content not saved yet is not cached at all, content not
+        # uploaded yet is cached again once uploaded.
+        if self.open_file.staged is not None:
+            self.direct_io = True
+        elif self.fs.writeback.get_content(self.open_file.doc_id) is not None:
+            self.keep_cache = self.fs.keep_kernel_cache(
+                self.open_file.doc_id, None)
+        else:
+            self.keep_cache = self.fs.keep_kernel_cache(
+                self.open_file.doc_id, self.open_file.binary_rev)
+        self.readahead = ReadAhead(self.fs.cache.block_size,
+                                   self.fs.mount_config['readahead'])
+
+    def read(self, size, offset):
+        """
+        Return content of the file. Content not saved yet is read from the
+        staging file, content not uploaded yet from the write-back queue,
+        stored content from the local block cache. When reads
+        are sequential, next blocks are downloaded in the background. Cache
+        warmup pauses while reads are running.
+            size {integer}: size of file part to read
+            offset {integer}: beginning of file part to read
+        """
+        self.fs.foreground.enter()
+        try:
+            open_file = self.open_file
+            staged = open_file.staged
+            if staged is not None:
+                return staged.read(size, offset)
+            buf = self.fs.read_pending(open_file.doc_id, size, offset)
+            if buf is not None:
+                return buf
+            if open_file.binary_id is None:
+                return -errno.ENOENT
+
+            # Fully cached files are memory mapped, nothing to prefetch.
+            if open_file.cache.mapped is None:
+                blocks = self.readahead.access(offset, size, open_file.size)
+                if len(blocks) > 0:
+                    self.fs.prefetcher.schedule(open_file.cache, blocks)
+            return self.fs.read_stored(open_file.cache, offset, size)
+
+        except IOError, e:
+            logger.warn(e)
+            # Binary revision not replicated yet, reading again may work.
+            if e.errno == errno.EAGAIN:
+                return -errno.EAGAIN
+            return -errno.EIO
+        except Exception, e:
+            logger.exception(e)
+            return -errno.EIO
+        finally:
+            self.fs.foreground.leave()
+
+    def write(self, buf, offset):
+        """
+        Write data in the file. Data are written at their offset in a local
+        staging file until the file is released.
+            buf {buffer}: data to write
+            offset {integer}: position of data in the file
+        """
+        try:
+            staged = self.open_file.staged
+            if staged is None:
+                staged = self.fs.stage(self.open_file)
+            return staged.write(buf, offset)
+
+        except Exception, e:
+            logger.exception(e)
+            return -errno.EIO
+
+    def ftruncate(self, size):
+        """
+        Change size of the file, saved when the file is released.
+        """
+        try:
+            self.fs.stage(self.open_file, size).truncate(size)
+            return 0
+
+        except Exception, e:
+            logger.exception(e)
+            return -errno.EIO
+
+    def fsync(self, isfsyncfile):
+        """
+        Content is saved when the file is released, there is nothing to
+        flush before.
+        """
+        return 0
+
+    def release(self, flags):
+        """
+        Release the handle. Release is called when there are no more
+        references to the handle: all file descriptors are closed and all
+        memory mappings are unmapped. Content is saved when the last handle
+        of the file is released.
+        """
+        try:
+            logger.info('release file %s' % self.open_file.path)
+            self.fs.release_file(self.open_file)
+            return 0
+
+        except Exception, e:
+            logger.exception(e)
+            return -errno.EIO
+
+
 class CouchFSDocument(fuse.Fuse):
     '''
     Fuse implementation behavior: handles synchronisation with database when a
@@ -76,11 +251,15 @@ class CouchFSDocument(fuse.Fuse):
         fuse.Fuse.__init__(self, *args, **kwargs)
         self.fuse_args.mountpoint = mountpoint
         self.fuse_args.add('allow_other')
-        self.currentFile = None
+        self.file_class = type('CouchFile', (CouchFile,), {'fs': self})
 
-        # Configure database
+        # Configure database, sessions are shared between FUSE threads.
         self.database = database
-        (self.db, self.server) = dbutils.get_db_and_server(database)
+        self.mount_config = local_config.get_mount_config(database)
+        (self.couch_session, self.http_session) = \
+            dbutils.get_sessions(self.mount_config['pool_size'])
+        (self.db, self.server) = \
+            dbutils.get_db_and_server(database, self.couch_session)
 
         ## Configure Cozy
         device = dbutils.get_device(database)
@@ -105,98 +284,190 @@ class CouchFSDocument(fuse.Fuse):
         self.rep_target = "https://%s:%s@%s/cozy" % string_data
 
         # init cache
-        self.dirs = {}
-        self.descriptors = {}
-        self.writeBuffers = {}
-
-    def add_file_to_dirs(self, path, name):
-        '''
-        Add file reference to directory cache.
-        '''
-        logger.info("path add: " + path)
-        path = _normalize_path(path)
-        filenames = self.dirs.setdefault(path, set())
-        filenames.add(name)
-        self.getattr(os.path.join(path, name))
-
-    def remove_file_from_dirs(self, path, name):
-        '''
-        Remove file reference from directory cache.
-        '''
-        logger.info("path remove: " + path)
-        if len(path) > 0:
-            file_path = os.path.join(path, name)
-        else:
-            file_path = name
-        path = _normalize_path(path)
-        file_path = _normalize_path(file_path)
-
-        filenames = self.get_dirs().setdefault(path, set())
-        if name in filenames:
-            filenames.remove(name)
-        self.descriptors.pop(file_path, None)
+        self.index = None
+        self.store = None
+        self.follower = None
+        self.negative = NegativeCache()
+        self.open_files = {}
+        self.kernel_revs = {}
+        self.files_lock = threading.Lock()
+        self.cache = BlockCache(
+            local_config.get_device_folder(database, 'cache'),
+            max_size=self.mount_config['cache_size'],
+            policy=self.mount_config['cache_policy'])
+        self.staging_folder = local_config.get_device_folder(
+            database, 'staging')
+        staging.clear_folder(self.staging_folder)
+        self.inodes = InodeTable(
+            os.path.join(local_config.get_device_folder(database), 'inodes'))
+        self.stats = None
+        self.stats_time = 0
+        self.stats_lock = threading.Lock()
+        self.prefetcher = Prefetcher(self._prefetch,
+                                     self.mount_config['prefetch_workers'])
+        self.pin_worker = PinWorker(database, self.db, self.cache,
+                                    self._fetch)
+        self.access_log = AccessLog()
+        self.foreground = ForegroundGate()
+        self.warmer = None
+        self.writeback = WriteBackQueue(
+            local_config.get_device_folder(database, 'writeback'))
+        self.uploader = Uploader(self.writeback, self._upload_entry)
+
+    def get_index(self):
+        """
+        Get path index, it is created on first call. Folders loaded during
+        previous mounts are read from the local metadata store, and changes
+        are followed from the last sequence applied to it.
+        """
+        if self.index is None:
+            self.store = MetaStore(os.path.join(
+                local_config.get_device_folder(self.database), 'index.db'))
+            index = PathIndex(self._load_folder,
+                              self.mount_config['index_size'])
+            index.seq = self.store.get_seq()
+            if index.seq is None:
+                index.seq = self.db.info()['update_seq']
+                self.store.set_seq(index.seq)
+            self.index = index
+        return self.index
+
+    def _load_folder(self, path):
+        """
+        Return documents of given folder, called by the path index the
+        first time the folder is accessed. Folders missing from the
+        metadata store are read from the database and stored.
+        """
+        docs = self.store.get_folder(path)
+        if docs is None:
+            docs = list(dbutils.get_folder_children(self.db, path))
+            self.store.save_folder(path, docs)
+        return docs
 
-    def get_dirs(self):
+    def fsinit(self):
         """
-        Get directories
+        Called once the file system is mounted: follow database changes to
+        keep the path index up to date, start background downloads and
+        uploads.
         """
         try:
-            if len(self.dirs.keys()) > 0:
-                return self.dirs
-            else:
-                self.dirs = {}
-
-                folders = dbutils.get_folders(self.db)
-                for folder in folders:
-                    folder_path = os.path.join(folder.value["path"],
-                                               folder.value["name"])
-                    if len(folder_path) != 0:
-                        folder_path = folder_path[0:]
-
-                    parents = [u'']
-                    for name in folder_path.split('/'):
-                        if name != '':
-                            path = u'/'.join(parents[1:])
-
-                            path = _normalize_path(path)
-                            filenames = self.dirs.setdefault(path, set())
-                            filenames.add(name)
-                            parents.append(name)
-
-                    folder_path = _normalize_path(folder_path)
-                    self.dirs.setdefault(u'' + folder_path, set())
-
-                files = dbutils.get_files(self.db)
-                for file_doc in files:
-                    file_path = os.path.join(
-                        file_doc.value["path"], file_doc.value["name"])
-                    parents = [u'']
-                    for name in file_path.split('/'):
-                        if name != '':
-                            path = u'/'.join(parents[1:])
-
-                            path = _normalize_path(path)
-                            filenames = self.dirs.setdefault(path, set())
-                            filenames.add(name)
-                            parents.append(name)
-
-            logger.info(self.dirs)
-            return self.dirs
-
+            index = self.get_index()
+            self.follower = ChangesFollower(self.db, index.seq,
+                                            self.apply_change,
+                                            self.store.set_seq)
+            self.follower.start()
+
+            self.warmer = Warmer(self.store, self.access_log, self.db.get,
+                                 self.cache, self._fetch, self.foreground,
+                                 self.mount_config['warmup_files'],
+                                 self.mount_config['warmup_workers'])
+            self.warmer.start()
         except Exception, e:
             logger.exception(e)
-            return {}
+        self.prefetcher.start()
+        self.pin_worker.start()
+        self.uploader.start()
+
+    def fsdestroy(self):
+        """
+        Called when the file system is unmounted. Files waiting for upload
+        are uploaded on next mount.
+        """
+        if self.follower is not None:
+            self.follower.stop()
+        self.prefetcher.stop()
+        self.pin_worker.stop()
+        if self.warmer is not None:
+            self.warmer.stop()
+        self.uploader.stop()
+        self.inodes.close()
+        logger.info('[Cache] %s' % self.cache.stats())
+        logger.info('[WriteBack] %s' % self.writeback.stats())
+        if self.store is not None:
+            self.store.close()
+
+    def lookup(self, path):
+        """
+        Return index node for given path. When path is not indexed, the
+        database is checked and the index updated with the result, unless
+        the content of its parent folder is fully loaded. Paths recently
+        found missing are not checked again.
+        """
+        index = self.get_index()
+        node = index.lookup(path)
+        if node is None and path not in self.negative:
+            parent = index.lookup(os.path.dirname(path))
+            if parent is not None and \
+                    (parent.loaded or not parent.is_folder()):
+                return None
+            doc = dbutils.get_folder(self.db, path)
+            if doc is None:
+                doc = dbutils.get_file(self.db, path)
+            if doc is not None:
+                node = index.add_doc(doc)
+            else:
+                self.negative.add(path)
+        return node
+
+    def get_inode(self, node, path):
+        """
+        Return inode number of given node. Folders that have no document
+        (created implicitly by their children) are identified by path.
+        """
+        if node is self.get_index().root:
+            return self.inodes.get(None)
+        elif node.doc_id is None:
+            return self.inodes.get(u'path:%s' % path)
+        else:
+            return self.inodes.get(node.doc_id)
+
+    def apply_change(self, change):
+        """
+        Apply a line of the database changes feed to the mount caches.
+        """
+        doc = change.get('doc')
+        if doc is not None and 'name' in doc:
+            self.negative.discard(_normalize_path(
+                u'%s/%s' % (doc.get('path', u''), doc['name'])))
+        self.get_index().apply_change(change)
+        self.store.apply_change(change)
+        self.pin_worker.notify(change)
 
     def readdir(self, path, offset):
         """
-        Generator: list files for given path and yield each file result when
-        it arrives.
+        Generator: list files for given path. Entries are yielded with their
+        type and inode number, taken from the path index. Folders indexed
+        without their document are completed with a single request.
         """
         path = _normalize_path(path)
         for directory in '.', '..':  # this two folders are conventional in Unix system.
-            yield fuse.Direntry(directory)
-        for name in self.get_dirs().get(path, set()):
-            yield fuse.Direntry(name.encode('utf-8'))
+            yield fuse.Direntry(directory, type=stat.S_IFDIR >> 12)
+
+        entries = self.get_index().entries(path)
+        self._complete_folders(path, entries)
+
+        for (name, node) in entries:
+            if node.is_folder():
+                mode = stat.S_IFDIR
+            else:
+                mode = stat.S_IFREG
+            ino = self.get_inode(node, _join_path(path, name))
+            yield fuse.Direntry(name.encode('utf-8'), type=mode >> 12,
+                                ino=ino)
+
+    def _complete_folders(self, path, entries):
+        """
+        Fetch documents of folders that were created in the index from their
+        children path only, so their attributes are known before getattr
+        is called on them.
+        """
+        paths = [_join_path(path, name) for (name, node) in entries
+                 if node.is_folder() and node.doc_id is None]
+        if len(paths) > 0:
+            index = self.get_index()
+            for doc in dbutils.get_docs_by_full_path(self.db, 'folder',
+                                                     paths):
+                index.add_doc(doc)
 
     def getattr(self, path):
         """
@@ -204,187 +475,351 @@ class CouchFSDocument(fuse.Fuse):
         """
         try:
             logger.debug('getattr %s' % path)
+            path = _normalize_path(path)
+            node = self.lookup(path)
 
-            # Result is cached.
-            if path in self.descriptors:
-                return self.descriptors[path]
-
-            else:
-                st = CouchStat()
+            if node is None:
+                logger.debug('File does not exist: %s' % path)
+                return -errno.ENOENT
 
-                # Path is root
-                if path is "/":
-                    st.st_mode = stat.S_IFDIR | 0775
-                    st.st_nlink = 2
-                    self.descriptors[path] = st
-                    return st
+            st = CouchStat()
+            st.st_ino = self.get_inode(node, path)
+            st.st_atime = node.mtime
+            st.st_ctime = node.mtime
+            st.st_mtime = node.mtime
 
+            if node.is_folder():
+                st.st_mode = stat.S_IFDIR | 0775
+                st.st_nlink = 2
+            else:
+                st.st_mode = stat.S_IFREG | 0664
+                st.st_nlink = 1
+                st.st_size = node.size
+
+                # File is being written, size is the staged one. Saved
+                # files waiting for upload have their queued size.
+                open_file = self._get_open_file(path)
+                if open_file is not None and open_file.staged is not None:
+                    st.st_size = open_file.staged.size
                 else:
-                    # Or path is a folder
-                    folder = dbutils.get_folder(self.db, path)
-
-                    if folder is not None:
-                        st.st_mode = stat.S_IFDIR | 0775
-                        st.st_nlink = 2
-                        if 'lastModification' in folder:
-                            st.st_atime = get_date(folder['lastModification'])
-                            st.st_ctime = st.st_atime
-                            st.st_mtime = st.st_atime
-
-                        self.descriptors[path] = st
-                        return st
-
-                    else:
-                        # Or path is a file
-                        file_doc = dbutils.get_file(self.db, path)
-
-                        if file_doc is not None:
-                            st.st_mode = stat.S_IFREG | 0664
-                            st.st_nlink = 1
-                            # TODO: if size is not set, get the binary
-                            # and save the information.
-                            st.st_size = file_doc.get('size', 4096)
-                            if 'lastModification' in file_doc:
-                                st.st_atime = \
-                                    get_date(file_doc['lastModification'])
-                                st.st_ctime = st.st_atime
-                                st.st_mtime = st.st_atime
-                            self.descriptors[path] = st
-                            return st
-
-                        else:
-                            print 'File does not exist: %s' % path
-                            return -errno.ENOENT
-                            return st
+                    pending = self.writeback.get_content(node.doc_id)
+                    if pending is not None:
+                        st.st_size = pending.size
+            return st
 
         except Exception, e:
             logger.exception(e)
             return -errno.ENOENT
 
-    def open(self, path, flags):
+    def acquire_file(self, path, node):
         """
-        Open file
-            path {string}: file path
-            flags {string}: opening mode
+        Return open file state of given path, shared by all handles opened
+        on it. Its reference count is incremented.
         """
-        path = _normalize_path(path)
-
-        try:
-            logger.info('open %s' % path)
-            parts = path.rsplit(u'/', 1)
-            if len(parts) == 1:
-                dirname, filename = u'', parts[0]
-            else:
-                dirname, filename = parts
-
-            logger.info(dirname)
-            logger.info(filename)
-            logger.info(self.dirs)
-            if filename in self.get_dirs()[dirname]:
-                logger.info('%s found' % filename)
-            else:
-                logger.error('File not found %s' % path)
-            return 0
-
-        except Exception, e:
-            logger.exception(e)
-            return -errno.ENOENT
-
-    def read(self, path, size, offset):
+        with self.files_lock:
+            open_file = self.open_files.get(path)
+            if open_file is None:
+                open_file = OpenFile(path, node, self.cache)
+                self.open_files[path] = open_file
+            open_file.refs += 1
+            return open_file
+
+    def keep_kernel_cache(self, doc_id, binary_rev):
         """
-        Return content of file located at given path.
-            path {string}: file path
-            size {integer}: size of file part to read
-            offset {integer}: beginning of file part to read
+        Return True if the binary revision of given file did not change
+        since it was last opened, so the kernel can keep its cached pages.
+        The revision is recorded for the next open.
         """
-        # TODO: do not load the file for each chunk.
-        # Save it in a cache file maybe?.
-        try:
-            path = _normalize_path(path)
-            logger.info('read %s' % path)
-            file_doc = dbutils.get_file(self.db, path)
-            binary_id = file_doc["binary"]["file"]["id"]
-            binary_attachment = self.db.get_attachment(binary_id, "file")
-            logger.info(binary_id)
+        with self.files_lock:
+            previous = self.kernel_revs.get(doc_id)
+            self.kernel_revs[doc_id] = binary_rev
+        return binary_rev is not None and previous == binary_rev
 
-            if binary_attachment is None:
-                logger.info('No attachment for this binary')
-                return ''
-
-            else:
-                content = binary_attachment.read()
-                content_length = len(content)
-                logger.info('Return file content')
-
-                if offset < content_length:
-                    if offset + size > content_length:
-                        size = content_length - offset
-                    buf = content[offset:offset+size]
+    def release_file(self, open_file):
+        """
+        Decrement reference count of given open file. When the last handle
+        is released, staged content is queued for upload. If queueing
+        fails, the open file stays registered so next release retries.
+        """
+        with self.files_lock:
+            open_file.refs -= 1
+            if open_file.refs > 0:
+                return
+            staged = open_file.staged
+
+        # Staged content is synced to disk without holding any lock, so
+        # closing a big file does not block other operations.
+        if staged is not None and staged.dirty:
+            staged.sync()
+
+        with self.files_lock:
+            if open_file.refs > 0 or open_file.released:
+                # Opened again meanwhile, its next release commits.
+                return
+
+            # Content is queued under the lock (it is only moved locally):
+            # an open of the same file waits for it instead of reusing the
+            # open file while it is committed.
+            self._commit(open_file)
+            open_file.released = True
+            if self.open_files.get(open_file.path) is open_file:
+                del self.open_files[open_file.path]
+            open_file.cache.close()
+
+    def _get_open_file(self, path):
+        """
+        Return open file state of given path or None if it is not open.
+        """
+        with self.files_lock:
+            return self.open_files.get(path)
 
-                else:
-                    buf = ''
-                    logger.info('Empty file content')
+    def _drop_open_files(self, path):
+        """
+        Forget open files located at or under given path, their content
+        is not saved when they are released.
+        """
+        with self.files_lock:
+            for open_path in self.open_files.keys():
+                if open_path == path or open_path.startswith(path + u'/'):
+                    self.open_files.pop(open_path).deleted = True
 
+    def _move_open_files(self, pathfrom, pathto):
+        """
+        Move open files of renamed paths to their new path.
+        """
+        with self.files_lock:
+            moved = []
+            for path in self.open_files.keys():
+                if path == pathfrom or path.startswith(pathfrom + u'/'):
+                    moved.append(self.open_files.pop(path))
+            for open_file in moved:
+                open_file.path = pathto + open_file.path[len(pathfrom):]
+                replaced = self.open_files.get(open_file.path)
+                if replaced is not None:
+                    replaced.deleted = True
+                self.open_files[open_file.path] = open_file
+
+    def read_pending(self, doc_id, size, offset):
+        """
+        Return part of the content of given file waiting for upload, None if
+        there is none. When the content leaves the queue while it is read
+        (uploaded or saved again), the queue is checked again.
+        """
+        previous = None
+        while True:
+            content = self.writeback.get_content(doc_id)
+            if content is None or content is previous:
+                return None
+            buf = content.read(size, offset)
+            if buf is not None:
                 return buf
+            previous = content
 
-        except Exception, e:
-            logger.exception(e)
-            return -errno.ENOENT
+    def read_stored(self, cache_handle, offset, size):
+        """
+        Return stored content of a binary revision from the local block
+        cache. Missing blocks are downloaded with a ranged request on the
+        attachment.
+        """
+        buf = cache_handle.read(offset, size)
+        if buf is None:
+            buf = self._fetch(cache_handle, offset, size)
+        return buf
 
-    def write(self, path, buf, offset):
+    def _fetch(self, cache_handle, offset, size):
         """
-        Write data in file located at given path.
-            path {string}: file path
-            buf {buffer}: data to write
+        Download blocks covering given part of the binary, store them in the
+        cache and return requested content. The cached revision is
+        requested, so content of another revision (a binary not replicated
+        yet) is never stored under it. Raises IOError when the revision is
+        not available or returns no content before the end of the binary.
         """
-        path = _normalize_path(path)
-        logger.info('write %s' % path)
-        if path not in self.writeBuffers:
-            self.writeBuffers[path] = ''
-        self.writeBuffers[path] = self.writeBuffers[path] + buf
-        return len(buf)
+        if size <= 0:
+            return ''
+
+        block_size = self.cache.block_size
+        start = (offset // block_size) * block_size
+        end = ((offset + size - 1) // block_size + 1) * block_size - 1
+
+        binary_id = cache_handle.binary_id
+        result = dbutils.get_attachment_range(self.db, binary_id, start, end,
+                                              session=self.http_session,
+                                              rev=cache_handle.rev)
+        if result is None:
+            raise IOError(errno.EAGAIN, 'Binary %s (rev %s) not available' %
+                          (binary_id, cache_handle.rev))
+
+        (data_offset, content, length) = result
+        begin = offset - data_offset
+        buf = content[begin:begin + size]
+        if len(buf) == 0 and (length is None or offset < length):
+            raise IOError(errno.EIO, 'No content for binary %s at %d' %
+                          (binary_id, offset))
+
+        cache_handle.store(data_offset, content, length=length)
+        return buf
+
+    def _prefetch(self, cache_handle, index):
+        """
+        Download given block of a binary revision if it is not cached yet.
+        """
+        block_size = self.cache.block_size
+        offset = index * block_size
+        if not cache_handle.contains(offset, block_size):
+            self._fetch(cache_handle, offset, block_size)
 
-    def release(self, path, fuse_file_info):
+    def stage(self, open_file, size=None):
         """
-        Save file to database and launch replication to remote Cozy.
-            path {string}: file path
-            fuse_file_info {struct}: information about open file
+        Return staging file of given open file. On first call, it is
+        created and initialized with the current file content (only the
+        first *size* bytes if given): content waiting for upload if any,
+        stored content otherwise. Raises IOError if stored content cannot
+        be read up to the file size, so partial writes never replace
+        missing content with zeros.
+        """
+        with open_file.lock:
+            if open_file.staged is not None:
+                return open_file.staged
+
+            staged = staging.StagingFile(self.staging_folder)
+            try:
+                self._seed(open_file, staged, size)
+            except Exception:
+                staged.remove()
+                raise
+            staged.dirty = False
+
+            open_file.staged = staged
+            return staged
+
+    def _seed(self, open_file, staged, size):
+        """
+        Copy current content of given open file to the staging file.
+        """
+        if size == 0:
+            return
+        block_size = self.cache.block_size
+        offset = 0
+        while size is None or offset < size:
+            buf = self.read_pending(open_file.doc_id, block_size, offset)
+            if buf is None:
+                if open_file.binary_id is None:
+                    break
+                buf = self.read_stored(open_file.cache, offset, block_size)
+                if len(buf) == 0 and offset < open_file.size:
+                    raise IOError(errno.EIO, '%s cannot be read at %d' %
+                                  (open_file.path, offset))
+            if len(buf) == 0:
+                break
+            staged.write(buf, offset)
+            offset += len(buf)
+
+    def _commit(self, open_file):
+        """
+        Queue staged content of given open file for upload. The staging file
+        is moved to the write-back queue, so release does not wait for the
+        database. Nothing is queued if the file was not modified. The
+        staging file is detached from the open file before it is queued,
+        it is attached again if queueing fails.
+        """
+        with open_file.lock:
+            (staged, open_file.staged) = (open_file.staged, None)
+        if staged is None:
+            return
+
+        if staged.dirty and not open_file.deleted:
+            try:
+                self.writeback.push(open_file.doc_id, open_file.binary_id,
+                                    open_file.path, staged)
+            except Exception:
+                with open_file.lock:
+                    open_file.staged = staged
+                raise
+            logger.info('%s queued for upload' % open_file.path)
+        else:
+            staged.remove()
+        logger.info("release is done")
 
-            Release is called when there are no more references
-            to an open file: all file descriptors are closed and
-            all memory mappings are unmapped.
+    def _upload_entry(self, entry):
         """
+        Save content of a write-back queue entry to database and launch
+        replication to remote Cozy, called by the uploader thread. Content
+        is streamed to the database with a chunked upload. The upload is
+        skipped if content is the same as the current binary one, the file
+        document is still saved if it does not match the binary (a previous
+        save failed after the upload). Entries of deleted files are dropped.
+        """
+        content = entry.content
         try:
-            path = _normalize_path(path)
-            logger.info('release file %s' % path)
-            file_doc = dbutils.get_file(self.db, path)
-            binary_id = file_doc["binary"]["file"]["id"]
-
-            if path in self.writeBuffers:
-                data = self.writeBuffers[path]
-                self.db.put_attachment(self.db[binary_id],
-                                       data,
-                                       filename="file")
-                file_doc['size'] = len(data)
-                self.writeBuffers.pop(path, None)
-
-            binary = self.db[binary_id]
-            file_doc['binary']['file']['rev'] = binary['_rev']
-            file_doc['lastModification'] = datetime.datetime.now().ctime()
-            self.db.save(file_doc)
-
-            logger.info("release is done")
-            return 0
-
-        except Exception, e:
-            logger.exception(e)
-            return -errno.ENOENT
+            binary = self.db[entry.binary_id]
+            file_doc = self.db[entry.doc_id]
+        except ResourceNotFound:
+            logger.warn('%s was deleted, upload dropped' % entry.path)
+            return
+
+        attachment = binary.get('_attachments', {}).get('file', {})
+        if attachment.get('length') == content.size and \
+                attachment.get('digest') == content.digest():
+            binary_rev = binary.rev
+            if file_doc.get('size') == content.size and \
+                    file_doc['binary']['file'].get('rev') == binary_rev:
+                logger.info('%s content is unchanged' % entry.path)
+                return
+        else:
+            binary_rev = self._upload(entry.path, content, binary.id,
+                                      binary.rev)
+        file_doc['size'] = content.size
+        file_doc['binary']['file']['rev'] = binary_rev
+        file_doc['lastModification'] = datetime.datetime.now().ctime()
+        self.db.save(file_doc)
+
+        node = self.get_index().ids.get(entry.doc_id)
+        if node is not None:
+            node.update(file_doc)
+        with self.files_lock:
+            open_files = [open_file for open_file in self.open_files.values()
+                          if open_file.doc_id == entry.doc_id]
+        for open_file in open_files:
+            open_file.update(file_doc, self.cache)
+
+    def _upload(self, path, staged, binary_id, binary_rev):
+        """
+        Stream staged content to the attachment of given binary and return
+        the new binary revision. The binary is fetched again if *binary_rev*
+        is outdated.
+        """
+        binary = {'_id': binary_id, '_rev': binary_rev}
+        stream = staged.stream(path)
+        try:
+            try:
+                self.db.put_attachment(binary, stream, filename="file")
+            except ResourceConflict:
+                stream.close()
+                stream = staged.stream(path)
+                binary = self.db[binary_id]
+                self.db.put_attachment(binary, stream, filename="file")
+        finally:
+            stream.close()
+
+        logger.info('%s uploaded: %d bytes at %.1f KB/s' %
+                    (path, stream.sent, stream.throughput() / 1024))
+        return binary['_rev']
+
+    def _create_file(self, path):
+        """
+        Create an empty file. The file and the binary documents (with an
+        empty attachment) are created in the database with a single
+        request. Returns the index node of the new file.
+        """
+        (file_path, name) = _path_split(path)
+        file_doc = dbutils.create_file(self.db, file_path, name)
+        node = self.get_index().add_doc(file_doc)
+        self.negative.discard(path)
+        return node
 
     def mknod(self, path, mode, dev):
         """
-        Create special/ordinary file. Since it's a new file, the file and
-        and the binary metadata are created in the database. Then file is saved
-        as an attachment to the database.
+        Create special/ordinary file.
             path {string}: file path
             mode {string}: file permissions
             dev: if the file type is S_IFCHR or S_IFBLK, dev specifies the
@@ -394,37 +829,13 @@ class CouchFSDocument(fuse.Fuse):
         try:
             path = _normalize_path(path)
             logger.info('mknod %s' % path)
-            (file_path, name) = _path_split(path)
-
-            file_path = _normalize_path(file_path)
-            new_binary = {"docType": "Binary"}
-            binary_id = self.db.create(new_binary)
-            self.db.put_attachment(self.db[binary_id], '', filename="file")
-
-            rev = self.db[binary_id]["_rev"]
-            newFile = {
-                "name": name,
-                "path": _normalize_path(file_path),
-                "binary": {
-                    "file": {
-                        "id": binary_id,
-                        "rev": rev
-                    }
-                },
-                "docType": "File",
-                'creationDate': datetime.datetime.now().ctime(),
-                'lastModification': datetime.datetime.now().ctime(),
-            }
-            self.db.create(newFile)
-
-            self.add_file_to_dirs(file_path, name)
+            self._create_file(path)
             logger.info('mknod is done for %s' % path)
             return 0
         except Exception, e:
             logger.exception(e)
             return -errno.ENOENT
 
-
     def unlink(self, path):
         """
         Remove file from database.
@@ -433,19 +844,17 @@ class CouchFSDocument(fuse.Fuse):
         try:
             path = _normalize_path(path)
             logger.info('unlink %s' % path)
-            parts = path.rsplit(u'/', 1)
-            if len(parts) == 1:
-                dirname, filename = u'', parts[0]
-            else:
-                dirname, filename = parts
 
-            file_doc = dbutils.get_file(self.db, path)
-            if file_doc is not None:
-                binary_id = file_doc["binary"]["file"]["id"]
-                self.db.delete(self.db[binary_id])
-                self.db.delete(self.db[file_doc["_id"]])
+            node = self.lookup(path)
+            if node is not None and not node.is_folder():
+                if node.binary_id is not None:
+                    self.db.delete(self.db[node.binary_id])
+                    self.cache.invalidate(node.binary_id)
+                self.db.delete(self.db[node.doc_id])
+                self.writeback.discard(node.doc_id)
+                self._drop_open_files(path)
 
-                self.remove_file_from_dirs(dirname, filename)
+                self.get_index().remove(path)
                 logger.info('file %s removed' % path)
                 return 0
             else:
@@ -457,10 +866,32 @@ class CouchFSDocument(fuse.Fuse):
             return -errno.ENOENT
 
     def truncate(self, path, size):
-        """ TODO: look if something should be done there.
-        Change size of a file.
         """
-        return 0
+        Change size of a file. When the file is open, new size is applied to
+        its staged content and saved when the file is released. Otherwise
+        it is saved right away.
+        """
+        try:
+            path = _normalize_path(path)
+            logger.info('truncate %s to %d' % (path, size))
+            open_file = self._get_open_file(path)
+            if open_file is not None:
+                self.stage(open_file, size).truncate(size)
+                return 0
+
+            node = self.lookup(path)
+            if node is None or node.is_folder():
+                return -errno.ENOENT
+            open_file = self.acquire_file(path, node)
+            try:
+                self.stage(open_file, size).truncate(size)
+            finally:
+                self.release_file(open_file)
+            return 0
+
+        except Exception, e:
+            logger.exception(e)
+            return -errno.EIO
 
     def utime(self, path, times):
         """ TODO: look if something should be done there.
@@ -478,16 +909,17 @@ class CouchFSDocument(fuse.Fuse):
             (folder_path, name) = _path_split(path)
 
             logger.info('create new dir %s' % path)
-            self.db.create({
+            folder = {
                 "name": name,
                 "path": _normalize_path(folder_path),
                 "docType": "Folder",
                 'creationDate': datetime.datetime.now().ctime(),
                 'lastModification': datetime.datetime.now().ctime(),
-            })
+            }
+            folder['_id'] = self.db.create(folder)
 
-            self.get_dirs().setdefault(path[1:], set())
-            self.getattr(path)
+            self.get_index().add_doc(folder)
+            self.negative.discard(_normalize_path(path))
             return 0
 
         except Exception, e:
@@ -496,17 +928,22 @@ class CouchFSDocument(fuse.Fuse):
 
     def rmdir(self, path):
         """
-        Delete folder from database.
+        Delete empty folder from database. Folders that still have entries
+        are not deleted.
             path {string}: diretory path
         """
         try:
             path = _normalize_path(path)
             logger.info('rmdir %s' % path)
-            folder = dbutils.get_folder(self.db, path)
-            self.db.delete(self.db[folder['_id']])
+            node = self.lookup(path)
+            if node is None or not node.is_folder():
+                return -errno.ENOENT
+            if len(self.get_index().entries(path)) > 0:
+                return -errno.ENOTEMPTY
 
-            self.dirs.pop(path, None)
-            self.descriptors.pop(path, None)
+            if node.doc_id is not None:
+                self.db.delete(self.db[node.doc_id])
+            self.get_index().remove(path)
             return 0
 
         except Exception, e:
@@ -515,44 +952,68 @@ class CouchFSDocument(fuse.Fuse):
 
     def rename(self, pathfrom, pathto):
         """
-        Rename file and subfiles (if it's a folder) in database.
+        Rename file or folder in database. Subfolders and subfiles of a
+        folder are moved with bulk updates. An existing file at the target
+        path is deleted (with its binary) in the same bulk update, like an
+        empty folder. Folders that are not empty are not replaced. If some
+        documents cannot be saved, the index is left as is: the changes
+        feed brings the documents that moved.
         """
         logger.info("path rename %s: " % pathfrom)
         pathfrom = _normalize_path(pathfrom)
         pathto = _normalize_path(pathto)
 
-        for doc in self.db.view("file/byFullPath", key=pathfrom):
-            doc = doc.value
-            (file_path, name) = _path_split(pathto)
-            doc.update({"name": name, "path": file_path})
-            self.db.save(doc)
-            return 0
-
-        for doc in self.db.view("folder/byFullPath", key=pathfrom):
-            doc = doc.value
-            (file_path, name) = _path_split(pathto)
-            doc.update({"name": name, "path": file_path})
+        try:
+            node = self.lookup(pathfrom)
+            if node is None or node is self.get_index().root:
+                return -errno.ENOENT
 
-            # Rename all subfiles
-            for res in self.db.view("file/byFolder", key=pathfrom):
-                pathfrom = os.path.join(res.value['path'], res.value['name'])
-                pathto = os.path.join(file_path, name, res.value['name'])
-                self.rename(pathfrom, pathto)
+            target = self.lookup(pathto)
+            replaced = []
+            if target is not None and target is not node:
+                if target.is_folder() and not node.is_folder():
+                    return -errno.EISDIR
+                elif node.is_folder() and not target.is_folder():
+                    return -errno.ENOTDIR
+                elif target.is_folder() and \
+                        len(self.get_index().entries(pathto)) > 0:
+                    return -errno.ENOTEMPTY
+                replaced = dbutils.get_deletion_stubs(
+                    self.db, [target.doc_id, target.binary_id])
 
-            for res in self.db.view("folder/byFolder", key=pathfrom):
-                pathfrom = os.path.join(res.value['path'], res.value['name'])
-                pathto = os.path.join(file_path, name, res.value['name'])
-                self.rename(pathfrom, pathto)
+            (file_path, name) = _path_split(pathto)
+            now = datetime.datetime.now().ctime()
 
-            self.db.save(doc)
+            if node.is_folder():
+                folder = None
+                if node.doc_id is not None:
+                    folder = self.db[node.doc_id]
+                    folder['lastModification'] = now
+                failed = dbutils.move_subtree(self.db, folder,
+                                              pathfrom, pathto, replaced)
 
-            # TODO update get_dirs
-            # TODO update last modification date
+            else:
+                doc = self.db[node.doc_id]
+                doc.update({"name": name, "path": file_path,
+                            "lastModification": now})
+                failed = dbutils.bulk_save(self.db, replaced + [doc])
+
+            if len(failed) > 0:
+                logger.error('%d documents not moved' % len(failed))
+                return -errno.EIO
+
+            if target is not None and target is not node:
+                self.writeback.discard(target.doc_id)
+                if target.binary_id is not None:
+                    self.cache.invalidate(target.binary_id)
+            self.get_index().move(pathfrom, pathto)
+            self._move_open_files(pathfrom, pathto)
+            self.negative.clear()
             return 0
 
-    def fsync(self, path, isfsyncfile):
-        """ TODO: look if something should be done there. """
-        return 0
+        except Exception, e:
+            logger.exception(e)
+            return -errno.EIO
 
     def chmod(self, path, mode):
         """ TODO: look if something should be done there. """
@@ -572,29 +1033,47 @@ class CouchFSDocument(fuse.Fuse):
             - totalfiles - total number of file inodes
             - freefiles - nunber of free file inodes
 
-        Feel free to set any of the above values to 0, which tells
-        the kernel that the info is not available.
+        Used space and number of files come from the file stats view. Files
+        are stored in the local database first, so free space is the one of
+        the local disk.
         """
         st = fuse.StatVfs()
 
-        blocks = 1024 * 1024
-        block_size = 1024
-        blocks_free = blocks
-        blocks_avail = blocks_free
-
-        files = 0
-        files_free = 0
+        (used, files) = self._get_stats()
+        local = os.statvfs(self.staging_folder)
+        block_size = STATFS_BLOCK_SIZE
+        blocks_used = (used + block_size - 1) // block_size
+        blocks_free = local.f_bfree * local.f_frsize // block_size
+        blocks_avail = local.f_bavail * local.f_frsize // block_size
 
         st.f_bsize = block_size
         st.f_frsize = block_size
-        st.f_blocks = blocks
+        st.f_blocks = blocks_used + blocks_free
         st.f_bfree = blocks_free
         st.f_bavail = blocks_avail
-        st.f_files = files
-        st.f_ffree = files_free
+        st.f_files = files + local.f_ffree
+        st.f_ffree = local.f_ffree
+        st.f_namemax = 255
 
         return st
 
+    def _get_stats(self):
+        """
+        Return total size and number of files. Results are kept for a few
+        seconds, as statfs is called often (by df or file managers).
+        """
+        with self.stats_lock:
+            if self.stats is None or \
+                    time.time() - self.stats_time > STATFS_TTL:
+                try:
+                    self.stats = dbutils.get_file_stats(self.db)
+                    self.stats_time = time.time()
+                except Exception, e:
+                    logger.exception(e)
+                    if self.stats is None:
+                        return (0, 0)
+            return self.stats
+
     def _replicate_from_local(self, ids):
         '''
         Replicate file modifications to remote Cozy.
@@ -606,11 +1085,22 @@ class CouchFSDocument(fuse.Fuse):
         )
 
 
+def _join_path(path, name):
+    '''
+    Return path of entry *name* of folder *path*.
+    '''
+    if path == '/':
+        return u'/' + name
+    return u'%s/%s' % (path, name)
+
+
 def _normalize_path(path):
     '''
     Remove trailing slash and/or empty path part.
     ex: /home//user/ becomes /home/user
     '''
+    if isinstance(path, str):
+        path = path.decode('utf-8')
     path = u'/'.join([part for part in path.split(u'/') if part != u''])
     if len(path) == 0:
         return '/'
@@ -643,5 +1133,23 @@ def unmount(path):
 def mount(name, path):
     logger.info('Attempt to mount %s' % path)
     fs = CouchFSDocument(name, path, 'http://localhost:5984/%s' % name)
-    fs.multithreaded = 0
+    fs.multithreaded = fs.mount_config['multithreaded']
+
+    # Inode numbers are given by the file system, and metadata are cached
+    # by the kernel for the configured durations (in seconds).
+    fs.fuse_args.add('use_ino')
+    for option in ('attr_timeout', 'entry_timeout'):
+        fs.fuse_args.add(option, str(fs.mount_config[option]))
+
+    # Transfer tuning: larger requests mean fewer calls to the Python
+    # handlers during bulk copies.
+    for option in ('big_writes', 'kernel_cache'):
+        if fs.mount_config[option]:
+            fs.fuse_args.add(option)
+    for option in ('max_write', 'max_read'):
+        fs.fuse_args.add(option, str(fs.mount_config[option]))
+    if fs.mount_config['async_read']:
+        fs.fuse_args.add('async_read')
+    else:
+        fs.fuse_args.add('sync_read')
     fs.main()
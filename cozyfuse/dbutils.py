@@ -1,6 +1,10 @@
 import json
+import uuid
+import base64
 import string
 import random
+import urllib
+import datetime
 import requests
 import logging
 
@@ -8,12 +12,17 @@ import local_config
 
 
 from couchdb import Server
-from couchdb.http import PreconditionFailed, ResourceConflict
+from couchdb.http import PreconditionFailed, ResourceConflict, Session
+from couchdb.http import ResourceNotFound
 
 logger = logging.getLogger(__name__)
 local_config.configure_logger(logger)
 
 
+BULK_SIZE = 1000
+PAGE_SIZE = 1000
+
+
 def create_db(database):
     server = Server('http://localhost:5984/')
     try:
@@ -42,12 +51,13 @@ def get_db(database, credentials=True):
         return None
 
 
-def get_db_and_server(database):
+def get_db_and_server(database, session=None):
     '''
-    Get or create given database from/in CouchDB.
+    Get or create given database from/in CouchDB. Requests go through
+    *session* when given, so its connection pool can be shared.
     '''
     try:
-        server = Server('http://localhost:5984/')
+        server = Server('http://localhost:5984/', session=session)
         server.resource.credentials = local_config.get_db_credentials(database)
         db = server[database]
         return (db, server)
@@ -56,6 +66,20 @@ def get_db_and_server(database):
         return (None, None)
 
 
+def get_sessions(pool_size):
+    '''
+    Return a CouchDB session and an HTTP session (used for ranged attachment
+    requests) that can be shared between threads. The HTTP session keeps up
+    to *pool_size* connections open.
+    '''
+    couch_session = Session()
+    http_session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=pool_size)
+    http_session.mount('http://', adapter)
+    return (couch_session, http_session)
+
+
 def init_db(database):
     '''
     Create all required views to make Cozy FUSE working properly.
@@ -96,6 +120,36 @@ def get_files(db):
     return db.view("file/all")
 
 
+def get_folder_children(db, path):
+    '''
+    Yield Folder and File documents located directly in folder *path*.
+    byFolder views are read by pages of PAGE_SIZE rows, next page starts
+    at the document id following the last row read.
+    '''
+    if path == '/':
+        # Documents of the root folder are stored with an empty path or
+        # with a slash.
+        keys = [u'', u'/']
+    else:
+        keys = [path]
+
+    for view in ('folder/byFolder', 'file/byFolder'):
+        for key in keys:
+            next_id = None
+            while True:
+                options = {'startkey': key, 'endkey': key,
+                           'limit': PAGE_SIZE + 1}
+                if next_id is not None:
+                    options['startkey_docid'] = next_id
+                rows = list(db.view(view, **options))
+
+                for row in rows[:PAGE_SIZE]:
+                    yield row.value
+                if len(rows) <= PAGE_SIZE:
+                    break
+                next_id = rows[PAGE_SIZE].id
+
+
 def get_folder(db, path):
     try:
         folder = list(db.view("folder/byFullPath", key=path))[0].value
@@ -112,6 +166,179 @@ def get_file(db, path):
     return file_doc
 
 
+def get_docs_by_full_path(db, doc_type, paths):
+    '''
+    Return documents of given type (file or folder) located at *paths*,
+    with one multi-key view query per batch of paths.
+    '''
+    docs = []
+    for start in range(0, len(paths), BULK_SIZE):
+        rows = db.view('%s/byFullPath' % doc_type,
+                       keys=paths[start:start + BULK_SIZE])
+        docs.extend([row.value for row in rows])
+    return docs
+
+
+def create_file(db, path, name, content=''):
+    '''
+    Create a File document named *name* in folder *path* and its Binary
+    document holding *content* as inline attachment, in a single _bulk_docs
+    request. Revisions are generated locally (new_edits=false) so the File
+    document can reference the binary revision. Returns the File document.
+    '''
+    now = datetime.datetime.now().ctime()
+    binary = {
+        "_id": uuid.uuid4().hex,
+        "_rev": "1-%s" % uuid.uuid4().hex,
+        "docType": "Binary",
+        "_attachments": {
+            "file": {
+                "content_type": "application/octet-stream",
+                "data": base64.b64encode(content)
+            }
+        }
+    }
+    file_doc = {
+        "_id": uuid.uuid4().hex,
+        "_rev": "1-%s" % uuid.uuid4().hex,
+        "name": name,
+        "path": path,
+        "binary": {
+            "file": {
+                "id": binary["_id"],
+                "rev": binary["_rev"]
+            }
+        },
+        "size": len(content),
+        "docType": "File",
+        "creationDate": now,
+        "lastModification": now,
+    }
+
+    for (success, doc_id, result) in db.update([binary, file_doc],
+                                               new_edits=False):
+        if not success:
+            raise result
+    return file_doc
+
+
+def get_subtree_docs(db, path):
+    '''
+    Return File and Folder documents located under folder *path* (the folder
+    itself excluded). One range query is run per document type.
+    '''
+    docs = []
+    for view in ("folder/byFolder", "file/byFolder"):
+        for row in db.view(view, startkey=path, endkey=path + u'\ufff0'):
+            doc_path = row.value['path']
+            if doc_path == path or doc_path.startswith(path + u'/'):
+                docs.append(row.value)
+    return docs
+
+
+def bulk_save(db, docs):
+    '''
+    Save given documents with _bulk_docs requests of BULK_SIZE documents.
+    Returns ids of documents that could not be saved.
+    '''
+    failed = []
+    for start in range(0, len(docs), BULK_SIZE):
+        for (success, doc_id, result) in db.update(
+                docs[start:start + BULK_SIZE]):
+            if not success:
+                logger.error('[DB] Cannot save %s: %s' % (doc_id, result))
+                failed.append(doc_id)
+    return failed
+
+
+def move_subtree(db, folder, pathfrom, pathto, replaced=None):
+    '''
+    Move *folder* document located at *pathfrom* and all its descendants to
+    *pathto* with bulk updates. *folder* can be None for a folder that has
+    no document. Deletions of *replaced* documents (see
+    get_deletion_stubs) are saved with the first bulk update. Returns ids
+    of documents that could not be moved or deleted.
+    '''
+    docs = list(replaced or [])
+    for doc in get_subtree_docs(db, pathfrom):
+        doc['path'] = pathto + doc['path'][len(pathfrom):]
+        docs.append(doc)
+
+    if folder is not None:
+        (folder['path'], folder['name']) = pathto.rsplit(u'/', 1)
+        docs.append(folder)
+    return bulk_save(db, docs)
+
+
+def get_deletion_stubs(db, doc_ids):
+    '''
+    Return documents deleting given documents when saved, read with a
+    single request. Documents missing or already deleted are skipped.
+    '''
+    stubs = []
+    doc_ids = [doc_id for doc_id in doc_ids if doc_id is not None]
+    if len(doc_ids) > 0:
+        for row in db.view('_all_docs', keys=doc_ids):
+            if row.value is not None and not row.value.get('deleted'):
+                stubs.append({'_id': row.id, '_rev': row.value['rev'],
+                              '_deleted': True})
+    return stubs
+
+
+def get_attachment_range(db, doc_id, start, end, filename='file',
+                         session=None, rev=None):
+    '''
+    Fetch bytes *start* to *end* (included) of given attachment with an HTTP
+    Range request. When *rev* is given, the attachment of that document
+    revision is fetched, not the latest one available locally. Returns a tuple (offset, content, length) where *offset*
+    is the position of *content* in the attachment and *length* the full
+    attachment length. If the server ignores the Range header, the whole
+    attachment is returned with an offset of 0.
+    Returns None if the attachment (or revision) does not exist.
+    '''
+    if session is None:
+        session = requests
+    url = '%s/%s/%s' % (db.resource.url,
+                        urllib.quote(doc_id, safe=''),
+                        urllib.quote(filename, safe=''))
+    params = {}
+    if rev is not None:
+        params['rev'] = rev
+    response = session.get(url, params=params,
+                           headers={'Range': 'bytes=%d-%d' % (start, end)},
+                           auth=db.resource.credentials)
+
+    if response.status_code == 404:
+        return None
+
+    elif response.status_code == 416:
+        length = _parse_content_range(
+            response.headers.get('content-range', ''))
+        return (start, '', length)
+
+    elif response.status_code == 206:
+        content = response.content
+        length = _parse_content_range(
+            response.headers.get('content-range', ''))
+        return (start, content, length)
+
+    else:
+        response.raise_for_status()
+        content = response.content
+        return (0, content, len(content))
+
+
+def _parse_content_range(content_range):
+    '''
+    Extract full length from a Content-Range header
+    (ex: bytes 0-99/1234 gives 1234). Returns None if length is unknown.
+    '''
+    try:
+        return int(content_range.rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
 def get_random_key():
     '''
     Generate a random key of 20 chars. The first character is not a number
@@ -204,6 +431,43 @@ def init_database_view(docType, db):
     }
 
 
+def init_stats_view(db):
+    '''
+    Add to the file design document a view reducing file sizes, so total
+    size and number of files are computed without listing files. Existing
+    design documents are updated.
+    '''
+    design = db.get('_design/file', {'_id': '_design/file', 'views': {}})
+    if 'stats' not in design['views']:
+        design['views']['stats'] = {
+            "map": """function (doc) {
+                          if (doc.docType === \"File\") {
+                              emit(null, doc.size || 0)
+                          }
+                      }""",
+            "reduce": "_stats"
+        }
+        db.save(design)
+        logger.info('[DB] File stats view created')
+
+
+def get_file_stats(db):
+    '''
+    Return total size and number of files stored in the database. The stats
+    view is created if it does not exist yet.
+    '''
+    try:
+        rows = list(db.view('file/stats'))
+    except ResourceNotFound:
+        init_stats_view(db)
+        rows = list(db.view('file/stats'))
+
+    if len(rows) == 0:
+        return (0, 0)
+    value = rows[0].value
+    return (int(value['sum']), value['count'])
+
+
 def init_database_views(database):
     '''
     Initialize database:
@@ -223,6 +487,7 @@ def init_database_views(database):
         logger.info('[DB] File design document created')
     except ResourceConflict:
         logger.warn('[DB] File design document already exists')
+    init_stats_view(db)
 
     try:
         db["_design/device"] = {
@@ -0,0 +1,73 @@
+import anydbm
+import hashlib
+import threading
+import logging
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+ROOT_INODE = 1
+INODE_BITS = 63
+
+
+class InodeTable(object):
+    '''
+    Persistent map of document ids to inode numbers. An inode is derived
+    from the MD5 digest of the document id, so it stays the same across
+    mounts even if the table is lost. Collisions are solved by probing the
+    next free number; numbers already given are never changed.
+    '''
+
+    def __init__(self, path):
+        self.db = anydbm.open(path, 'c')
+        self.inodes = {}
+        self.used = set([ROOT_INODE])
+        self.lock = threading.Lock()
+
+        for key in self.db.keys():
+            inode = int(self.db[key])
+            self.inodes[key] = inode
+            self.used.add(inode)
+        logger.info('[Inodes] %d inodes loaded' % len(self.inodes))
+
+    def get(self, key):
+        '''
+        Return inode number of given document id (or path for entries that
+        have no document), allocate it on first call.
+        '''
+        if key is None:
+            return ROOT_INODE
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+
+        with self.lock:
+            inode = self.inodes.get(key)
+            if inode is None:
+                inode = derive_inode(key)
+                while inode in self.used:
+                    inode = inode % (2 ** INODE_BITS - 1) + 1
+                self.inodes[key] = inode
+                self.used.add(inode)
+                self.db[key] = str(inode)
+            return inode
+
+    def sync(self):
+        with self.lock:
+            if hasattr(self.db, 'sync'):
+                self.db.sync()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def derive_inode(key):
+    '''
+    Return inode number matching given key, before collision probing.
+    '''
+    digest = hashlib.md5(key).hexdigest()
+    inode = int(digest[:16], 16) & (2 ** INODE_BITS - 1)
+    return max(inode, ROOT_INODE + 1)
@@ -1,4 +1,5 @@
 import os
+import shutil
 import daemon
 import lockfile
 import logging
@@ -10,6 +11,25 @@ from yaml import Loader
 CONFIG_FOLDER = os.path.join(os.path.expanduser('~'), '.cozyfuse')
 CONFIG_PATH = os.path.join(CONFIG_FOLDER, 'config.yaml')
 
+MOUNT_DEFAULTS = {
+    'multithreaded': True,
+    'pool_size': 10,
+    'readahead': 32,
+    'prefetch_workers': 2,
+    'attr_timeout': 5,
+    'entry_timeout': 5,
+    'big_writes': True,
+    'max_write': 128 * 1024,
+    'max_read': 128 * 1024,
+    'async_read': True,
+    'kernel_cache': False,
+    'index_size': 200000,
+    'cache_size': 1024 * 1024 * 1024,
+    'cache_policy': 'lru',
+    'warmup_files': 100,
+    'warmup_workers': 2,
+}
+
 HDLR = logging.FileHandler(os.path.join(CONFIG_FOLDER, 'cozyfuse.log'))
 HDLR.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
 
@@ -80,7 +100,7 @@ def remove_config(name):
 
     folder = os.path.join(CONFIG_FOLDER, name)
     if os.path.isdir(folder):
-        os.rmdir(folder)
+        shutil.rmtree(folder)
     logger.info('[Config] Configuration for %s removed' % name)
 
 
@@ -154,6 +174,50 @@ def get_db_credentials(name):
     return (db_login, db_password)
 
 
+def get_mount_config(name):
+    '''
+    Return mount options of device *name*. Options are read from the *mount*
+    section of the device configuration, missing ones get default values.
+    '''
+    config = get_full_config()
+
+    if name not in config:
+        raise NoConfigFound('[Config] No device is registered for %s' % name)
+
+    mount_config = dict(MOUNT_DEFAULTS)
+    mount_config.update(config[name].get('mount') or {})
+    return mount_config
+
+
+def get_pins(name):
+    '''
+    Return paths of the folders pinned on device *name*.
+    '''
+    config = get_full_config()
+
+    if name not in config:
+        raise NoConfigFound('[Config] No device is registered for %s' % name)
+
+    return list(config[name].get('pins') or [])
+
+
+def set_pins(name, pins):
+    '''
+    Save paths of the folders pinned on device *name*.
+    '''
+    config = get_full_config()
+
+    if name not in config:
+        raise NoConfigFound('[Config] No device is registered for %s' % name)
+
+    else:
+        config[name]['pins'] = sorted(set(pins))
+
+        output_file = file(CONFIG_PATH, 'w')
+        dump(config, output_file, default_flow_style=False)
+        logger.info('[Config] Pinned folders saved')
+
+
 def get_full_config():
     '''
     Get config (~/.cozyfuse/config.yaml) file as a dict.
@@ -181,6 +245,17 @@ def clear():
     os.remove(CONFIG_PATH)
 
 
+def get_device_folder(name, *subfolders):
+    '''
+    Return working folder of device *name* (~/.cozyfuse/name) or one of its
+    subfolders. Folder is created if it doesn't exist.
+    '''
+    folder = os.path.join(CONFIG_FOLDER, name, *subfolders)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    return folder
+
+
 def get_daemon_context(device_name, daemon_name):
     '''
     Return a proper daemon context:
@@ -0,0 +1,196 @@
+import json
+import sqlite3
+import threading
+import logging
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS meta (
+           key TEXT PRIMARY KEY,
+           value TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS folders (
+           path TEXT PRIMARY KEY)''',
+    '''CREATE TABLE IF NOT EXISTS docs (
+           id TEXT PRIMARY KEY,
+           parent TEXT,
+           doc TEXT)''',
+    '''CREATE INDEX IF NOT EXISTS docs_parent ON docs (parent)''',
+    '''CREATE TABLE IF NOT EXISTS accesses (
+           id TEXT PRIMARY KEY,
+           count INTEGER,
+           last REAL)''',
+]
+
+
+class MetaStore(object):
+    '''
+    SQLite copy of the folders loaded in the path index, with the last
+    sequence of the changes feed applied to it. On remount, loaded folders
+    are read from it and only changes since that sequence are replayed.
+    It also keeps the number of opens and last open time of each file.
+    '''
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+            self.connection.commit()
+
+    def get_seq(self):
+        '''
+        Return last sequence applied to the store, None for a new store.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value FROM meta WHERE key = ?', ('seq',)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set_seq(self, seq):
+        '''
+        Record *seq* as applied and commit pending changes.
+        '''
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                ('seq', json.dumps(seq)))
+            self.connection.commit()
+
+    def get_folder(self, path):
+        '''
+        Return documents of folder located at *path*, or None if the folder
+        is not stored.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT path FROM folders WHERE path = ?', (path,)).fetchone()
+            if row is None:
+                return None
+            rows = self.connection.execute(
+                'SELECT doc FROM docs WHERE parent = ?', (path,)).fetchall()
+        return [json.loads(doc) for (doc,) in rows]
+
+    def save_folder(self, path, docs):
+        '''
+        Store documents of folder located at *path*.
+        '''
+        with self.lock:
+            self.connection.execute(
+                'DELETE FROM docs WHERE parent = ?', (path,))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO docs (id, parent, doc) '
+                'VALUES (?, ?, ?)',
+                [(doc['_id'], path, json.dumps(doc)) for doc in docs])
+            self.connection.execute(
+                'INSERT OR REPLACE INTO folders (path) VALUES (?)', (path,))
+            self.connection.commit()
+
+    def apply_change(self, change):
+        '''
+        Apply a line of the database changes feed (with included document).
+        Documents are stored only if their folder is stored. Stored content
+        of a moved or deleted folder is dropped, it is read again from the
+        database when needed.
+        '''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT doc FROM docs WHERE id = ?',
+                (change['id'],)).fetchone()
+            if row is not None:
+                previous = json.loads(row[0])
+                if previous.get('docType') == 'Folder':
+                    self._drop_folder(_get_path(previous), change)
+                self.connection.execute(
+                    'DELETE FROM docs WHERE id = ?', (change['id'],))
+
+            doc = change.get('doc')
+            if change.get('deleted') or doc is None or \
+                    doc.get('docType') not in ('File', 'Folder'):
+                return
+
+            parent = _get_parent(doc)
+            stored = self.connection.execute(
+                'SELECT path FROM folders WHERE path = ?',
+                (parent,)).fetchone()
+            if stored is not None:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO docs (id, parent, doc) '
+                    'VALUES (?, ?, ?)',
+                    (doc['_id'], parent, json.dumps(doc)))
+
+    def _drop_folder(self, path, change):
+        '''
+        Forget stored content of folder *path* and its subfolders, unless
+        the change keeps the folder at the same path.
+        '''
+        doc = change.get('doc')
+        if not change.get('deleted') and doc is not None and \
+                doc.get('docType') == 'Folder' and _get_path(doc) == path:
+            return
+
+        pattern = path.replace('%', '\\%').replace('_', '\\_') + u'/%'
+        self.connection.execute(
+            "DELETE FROM folders WHERE path = ? OR path LIKE ? ESCAPE '\\'",
+            (path, pattern))
+        self.connection.execute(
+            "DELETE FROM docs WHERE parent = ? OR parent LIKE ? ESCAPE '\\'",
+            (path, pattern))
+
+    def record_accesses(self, accesses):
+        '''
+        Add given file accesses, a dict of file document id to (number of
+        opens, last open time), to the access history.
+        '''
+        with self.lock:
+            for (doc_id, (count, last)) in accesses.items():
+                self.connection.execute(
+                    'INSERT OR IGNORE INTO accesses (id, count, last) '
+                    'VALUES (?, 0, 0)', (doc_id,))
+                self.connection.execute(
+                    'UPDATE accesses SET count = count + ?, last = ? '
+                    'WHERE id = ?', (count, last, doc_id))
+            self.connection.commit()
+
+    def get_hot_files(self, limit):
+        '''
+        Return ids of the *limit* most opened files, most recent first
+        among files opened as often.
+        '''
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id FROM accesses ORDER BY count DESC, last DESC '
+                'LIMIT ?', (limit,)).fetchall()
+        return [doc_id for (doc_id,) in rows]
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.commit()
+                self.connection.close()
+                self.connection = None
+
+
+def _get_parent(doc):
+    '''
+    Return normalized path of the folder containing given document.
+    '''
+    parts = [part for part in doc.get('path', u'').split(u'/') if part]
+    return u'/' + u'/'.join(parts)
+
+
+def _get_path(doc):
+    '''
+    Return normalized path of given document.
+    '''
+    parent = _get_parent(doc)
+    if parent == u'/':
+        return parent + doc['name']
+    return u'%s/%s' % (parent, doc['name'])
@@ -0,0 +1,411 @@
+import time
+import datetime
+import calendar
+import threading
+import logging
+import collections
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+FOLDER = 'folder'
+FILE = 'file'
+
+NEGATIVE_CACHE_SIZE = 4096
+NEGATIVE_CACHE_TTL = 30
+INDEX_SIZE = 200000
+
+
+def get_date(ctime):
+    ctime = ctime[0:24]
+    try:
+        date = datetime.datetime.strptime(ctime, "%a %b %d %H:%M:%S %Y")
+    except ValueError:
+        date = datetime.datetime.strptime(ctime, "%a %b %d %Y %H:%M:%S")
+    return calendar.timegm(date.utctimetuple())
+
+
+class PathNode(object):
+    '''
+    Entry of the path index. Folders hold their children by name, files hold
+    the binary they are linked to.
+    '''
+    __slots__ = ('name', 'parent', 'children', 'type', 'doc_id', 'size',
+                 'mtime', 'binary_id', 'binary_rev', 'loaded')
+
+    def __init__(self, name, node_type, parent=None):
+        self.name = name
+        self.parent = parent
+        self.type = node_type
+        self.doc_id = None
+        self.size = 0
+        self.mtime = 0
+        self.binary_id = None
+        self.binary_rev = None
+        self.loaded = False
+        if node_type == FOLDER:
+            self.children = {}
+        else:
+            self.children = None
+
+    def is_folder(self):
+        return self.type == FOLDER
+
+    def update(self, doc):
+        '''
+        Copy document attributes to the node.
+        '''
+        self.doc_id = doc.get('_id', self.doc_id)
+
+        if 'lastModification' in doc:
+            try:
+                self.mtime = get_date(doc['lastModification'])
+            except ValueError:
+                logger.warn('Wrong date format for %s' % self.name)
+
+        if self.type == FILE:
+            self.size = doc.get('size', 0)
+            try:
+                binary = doc['binary']['file']
+                self.binary_id = binary['id']
+                self.binary_rev = binary.get('rev')
+            except (KeyError, TypeError):
+                self.binary_id = None
+                self.binary_rev = None
+
+
+class PathIndex(object):
+    '''
+    In-memory trie of the folders and files stored in the database. Paths
+    are resolved in O(depth) without querying the database.
+
+    When a *loader* is given, folders are loaded on first access: the
+    loader is called with the folder path and returns the documents it
+    contains. Least recently used folders are unloaded when the index holds
+    more than *max_size* nodes.
+    '''
+
+    def __init__(self, loader=None, max_size=INDEX_SIZE):
+        self.root = PathNode(u'', FOLDER)
+        self.ids = {}
+        self.seq = 0
+        self.loader = loader
+        self.max_size = max_size
+        self.size = 1
+        self.loaded = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def lookup(self, path):
+        '''
+        Return node located at *path* or None if no such node exists.
+        Folders on the way are loaded if needed.
+        '''
+        node = self.root
+        for name in _split(path):
+            if node.children is None:
+                return None
+            self.load(node)
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def list(self, path):
+        '''
+        Return names of the entries of folder located at *path*.
+        '''
+        return [name for (name, node) in self.entries(path)]
+
+    def entries(self, path):
+        '''
+        Return (name, node) pairs of the entries of folder located at
+        *path*.
+        '''
+        node = self.lookup(path)
+        if node is None or node.children is None:
+            return []
+        self.load(node)
+        with self.lock:
+            return node.children.items()
+
+    def load(self, node):
+        '''
+        Load children of given folder node if it is not loaded yet. The
+        loader is called without holding the index lock.
+        '''
+        if node.loaded:
+            with self.lock:
+                if node in self.loaded:
+                    del self.loaded[node]
+                    self.loaded[node] = True
+            return
+
+        docs = []
+        if self.loader is not None:
+            docs = list(self.loader(self.get_path(node)))
+
+        with self.lock:
+            if node.loaded or not self._is_attached(node):
+                return
+            for doc in docs:
+                self._add_doc(doc)
+            self._mark_loaded(node)
+            self._shrink(node)
+        logger.debug('[Index] %d documents loaded for %s' %
+                     (len(docs), node.name))
+
+    def get_path(self, node):
+        '''
+        Return full path of given node.
+        '''
+        names = []
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return u'/' + u'/'.join(reversed(names))
+
+    def add_doc(self, doc):
+        '''
+        Add or update the node matching given File or Folder document.
+        Missing parent folders are created. Returns the node.
+        '''
+        with self.lock:
+            return self._add_doc(doc)
+
+    def _add_doc(self, doc):
+        if doc.get('docType') == 'Folder':
+            node_type = FOLDER
+        else:
+            node_type = FILE
+
+        path = u'%s/%s' % (doc.get('path', u''), doc['name'])
+        names = _split(path)
+        if len(names) == 0:
+            return self.root
+
+        parent = self._make_folders(names[:-1])
+        node = parent.children.get(names[-1])
+        if node is not None and node.type != node_type:
+            self._detach(node)
+            node = None
+        if node is None:
+            node = PathNode(names[-1], node_type, parent)
+            parent.children[node.name] = node
+            self.size += 1
+
+        if node.doc_id is not None and node.doc_id != doc.get('_id'):
+            self.ids.pop(node.doc_id, None)
+        node.update(doc)
+        if node.doc_id is not None:
+            self.ids[node.doc_id] = node
+        return node
+
+    def remove(self, path):
+        '''
+        Remove node located at *path* and all its descendants.
+        Returns the removed node.
+        '''
+        with self.lock:
+            node = self._find(_split(path))
+            if node is not None and node is not self.root:
+                self._detach(node)
+            return node
+
+    def move(self, pathfrom, pathto):
+        '''
+        Move node located at *pathfrom* (and its descendants) to *pathto*.
+        An existing node at *pathto* is replaced, except folder children
+        that are merged into the moved folder.
+        '''
+        with self.lock:
+            node = self._find(_split(pathfrom))
+            names = _split(pathto)
+            if node is None or node is self.root or len(names) == 0:
+                return None
+
+            del node.parent.children[node.name]
+            parent = self._make_folders(names[:-1])
+            previous = parent.children.get(names[-1])
+            if previous is not None:
+                if previous.is_folder() and node.is_folder():
+                    for name, child in previous.children.items():
+                        if name not in node.children:
+                            del previous.children[name]
+                            child.parent = node
+                            node.children[name] = child
+                self._detach(previous)
+
+            node.name = names[-1]
+            node.parent = parent
+            parent.children[node.name] = node
+            return node
+
+    def apply_change(self, change):
+        '''
+        Apply a line of the database changes feed (with included document)
+        to the index: create, update, move or delete the matching node.
+        Documents located in folders that are not loaded are skipped, they
+        will be read when their folder is loaded.
+        '''
+        with self.lock:
+            doc = change.get('doc')
+            node = self.ids.get(change['id'])
+
+            if change.get('deleted'):
+                if node is not None:
+                    self._detach(node)
+
+            elif doc is not None and \
+                    doc.get('docType') in ('File', 'Folder'):
+                names = _split(u'%s/%s' % (doc.get('path', u''), doc['name']))
+                parent = self._find(names[:-1])
+                if parent is None or not parent.loaded:
+                    if node is not None:
+                        self._detach(node)
+                else:
+                    path = u'/' + u'/'.join(names)
+                    if node is not None and self.get_path(node) != path:
+                        self.move(self.get_path(node), path)
+                    self._add_doc(doc)
+
+            self.seq = change.get('seq', self.seq)
+
+    def _find(self, names):
+        '''
+        Return node matching given path parts among loaded nodes.
+        '''
+        node = self.root
+        for name in names:
+            if node.children is None:
+                return None
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def _make_folders(self, names):
+        '''
+        Return folder node matching given path parts, create missing ones.
+        '''
+        node = self.root
+        for name in names:
+            child = node.children.get(name)
+            if child is None or not child.is_folder():
+                if child is not None:
+                    self._detach(child)
+                child = PathNode(name, FOLDER, node)
+                node.children[name] = child
+                self.size += 1
+            node = child
+        return node
+
+    def _mark_loaded(self, node):
+        node.loaded = True
+        self.loaded.pop(node, None)
+        self.loaded[node] = True
+
+    def _is_attached(self, node):
+        '''
+        Return True if given node is still linked to the root.
+        '''
+        while node.parent is not None:
+            if node.parent.children.get(node.name) is not node:
+                return False
+            node = node.parent
+        return node is self.root
+
+    def _shrink(self, keep):
+        '''
+        Unload least recently used folders until the index fits in its
+        maximum size. Folder *keep* and its ancestors are not unloaded.
+        '''
+        if self.loader is None:
+            return
+        protected = set()
+        while keep is not None:
+            protected.add(keep)
+            keep = keep.parent
+
+        for node in self.loaded.keys():
+            if self.size <= self.max_size:
+                break
+            if node in protected or not node.loaded:
+                continue
+            logger.debug('[Index] Unload %s' % node.name)
+            for child in node.children.values():
+                self._detach(child)
+            node.loaded = False
+            self.loaded.pop(node, None)
+
+    def _detach(self, node):
+        '''
+        Remove node from its parent and forget ids of its subtree.
+        '''
+        if node.parent is not None:
+            node.parent.children.pop(node.name, None)
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            self.size -= 1
+            if current.doc_id is not None:
+                self.ids.pop(current.doc_id, None)
+            if current.children is not None:
+                self.loaded.pop(current, None)
+                stack.extend(current.children.values())
+
+
+class NegativeCache(object):
+    '''
+    Bounded set of paths known not to exist. Entries expire after *ttl*
+    seconds, oldest entries are dropped when *max_size* is reached.
+    '''
+
+    def __init__(self, max_size=NEGATIVE_CACHE_SIZE, ttl=NEGATIVE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.paths = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, path):
+        with self.lock:
+            expiry = self.paths.get(path)
+            if expiry is None:
+                return False
+            elif expiry < time.time():
+                del self.paths[path]
+                return False
+            else:
+                return True
+
+    def add(self, path):
+        '''
+        Mark *path* as missing.
+        '''
+        with self.lock:
+            self.paths.pop(path, None)
+            self.paths[path] = time.time() + self.ttl
+            while len(self.paths) > self.max_size:
+                self.paths.popitem(last=False)
+
+    def discard(self, path):
+        '''
+        Forget *path*, it may exist now.
+        '''
+        with self.lock:
+            self.paths.pop(path, None)
+
+    def clear(self):
+        with self.lock:
+            self.paths.clear()
+
+
+def _split(path):
+    '''
+    Return non empty parts of given path as unicode strings.
+    '''
+    if isinstance(path, str):
+        path = path.decode('utf-8')
+    return [part for part in path.split(u'/') if part != u'']
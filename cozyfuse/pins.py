@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import Queue
+import threading
+import logging
+
+import dbutils
+import local_config
+from cache import download
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+CHECK_DELAY = 30
+RESCAN_DELAY = 3600
+STATUS_STEP = 50
+STATUS_FILE = 'pins.json'
+
+
+class PinWorker(threading.Thread):
+    '''
+    Background thread keeping the binaries of pinned folders in the block
+    cache, so they are available offline. Pinned folders are read from the
+    device configuration every CHECK_DELAY seconds and fully scanned when
+    they change (or every RESCAN_DELAY seconds). Files modified in them
+    are downloaded as soon as their change arrives. Pinned binaries are
+    protected from cache eviction. Progress is written to the pins.json
+    file of the device folder.
+    '''
+
+    def __init__(self, device, db, cache, fetch):
+        threading.Thread.__init__(self, name='pin-worker')
+        self.daemon = True
+        self.device = device
+        self.db = db
+        self.cache = cache
+        self.fetch = fetch
+        self.pins = []
+        self.status = {}
+        self.queue = Queue.Queue()
+        self.stopped = threading.Event()
+        self.status_path = get_status_path(device)
+
+    def run(self):
+        last_scan = 0
+        next_check = 0
+        while not self.stopped.is_set():
+            if time.time() >= next_check:
+                next_check = time.time() + CHECK_DELAY
+                try:
+                    pins = [normalize(pin) for pin in
+                            local_config.get_pins(self.device)]
+                    if pins != self.pins or \
+                            time.time() - last_scan > RESCAN_DELAY:
+                        self.scan(pins)
+                        last_scan = time.time()
+                except Exception:
+                    logger.exception('[Pins] Cannot scan pinned folders')
+
+            try:
+                doc = self.queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            try:
+                self.cache.pin(doc['binary']['file']['id'])
+                self.materialize(doc)
+            except Exception:
+                logger.exception('[Pins] Cannot download %s' % doc['name'])
+
+    def stop(self):
+        self.stopped.set()
+
+    def notify(self, change):
+        '''
+        Queue download of the file of given change if it is located in a
+        pinned folder.
+        '''
+        doc = change.get('doc')
+        if change.get('deleted') or doc is None or \
+                doc.get('docType') != 'File' or 'binary' not in doc:
+            return
+        if get_pin(self.pins, doc.get('path', u'')) is not None:
+            self.queue.put(doc)
+
+    def scan(self, pins):
+        '''
+        List files of given pinned folders, pin their binaries in the cache
+        and download the missing ones.
+        '''
+        self.pins = pins
+
+        files = []
+        binary_ids = set()
+        status = {}
+        for pin in pins:
+            query_path = pin
+            if pin == u'/':
+                query_path = u''
+            docs = [doc for doc in dbutils.get_subtree_docs(self.db,
+                                                            query_path)
+                    if doc.get('docType') == 'File' and 'binary' in doc]
+            for doc in docs:
+                binary_ids.add(doc['binary']['file']['id'])
+            status[pin] = {
+                'files': len(docs),
+                'bytes': sum([doc.get('size', 0) for doc in docs]),
+                'cached_files': 0,
+                'cached_bytes': 0,
+            }
+            files.append((pin, docs))
+
+        self.cache.set_pinned(binary_ids)
+        self.status = status
+        self.write_status()
+
+        for (pin, docs) in files:
+            for (number, doc) in enumerate(docs):
+                if self.stopped.is_set():
+                    return
+                try:
+                    self.materialize(doc)
+                    status[pin]['cached_files'] += 1
+                    status[pin]['cached_bytes'] += doc.get('size', 0)
+                except Exception:
+                    logger.exception('[Pins] Cannot download %s' % doc['name'])
+                if number % STATUS_STEP == 0:
+                    self.write_status()
+
+            logger.info('[Pins] %s: %d/%d files available offline' %
+                        (pin, status[pin]['cached_files'],
+                         status[pin]['files']))
+        self.write_status()
+
+    def materialize(self, doc):
+        '''
+        Download blocks of the file binary that are not cached yet.
+        '''
+        binary = doc['binary']['file']
+        download(self.cache, self.fetch, binary['id'], binary.get('rev'),
+                 doc.get('size', 0), self.stopped)
+
+    def write_status(self):
+        status = {
+            'updated': time.time(),
+            'pins': self.status,
+        }
+        with open(self.status_path, 'w') as status_file:
+            json.dump(status, status_file)
+
+
+def get_status_path(device):
+    return os.path.join(local_config.get_device_folder(device), STATUS_FILE)
+
+
+def read_status(device):
+    '''
+    Return pin status written by the mount of given device, None if the
+    device was never mounted with pinned folders.
+    '''
+    try:
+        with open(get_status_path(device)) as status_file:
+            return json.load(status_file)
+    except (IOError, ValueError):
+        return None
+
+
+def normalize(path):
+    '''
+    Return pinned folder path with a leading slash and no trailing one.
+    '''
+    if isinstance(path, str):
+        path = path.decode('utf-8')
+    return u'/' + u'/'.join([part for part in path.split(u'/') if part])
+
+
+def get_pin(pins, path):
+    '''
+    Return pinned folder containing folder *path*, None if it is not
+    pinned.
+    '''
+    path = normalize(path)
+    for pin in pins:
+        if pin == u'/' or path == pin or path.startswith(pin + u'/'):
+            return pin
+    return None
@@ -0,0 +1,115 @@
+import Queue
+import threading
+import logging
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+READAHEAD_MAX = 32
+PREFETCH_WORKERS = 2
+
+
+class ReadAhead(object):
+    '''
+    Sequential access detection of an open file. While reads follow each
+    other, the readahead window (in blocks) doubles up to *max_window*. A
+    random seek collapses it.
+    '''
+
+    def __init__(self, block_size, max_window=READAHEAD_MAX):
+        self.block_size = block_size
+        self.max_window = max_window
+        self.next_offset = None
+        self.window = 0
+        self.prefetched = -1
+        self.lock = threading.Lock()
+
+    def access(self, offset, size, length=None):
+        '''
+        Record a read of *size* bytes at *offset* and return indexes of the
+        blocks to prefetch. Reads reordered by less than a block are still
+        considered sequential. Blocks after *length* are not returned.
+        '''
+        with self.lock:
+            sequential = self.next_offset is not None and \
+                abs(offset - self.next_offset) <= self.block_size
+            self.next_offset = offset + size
+
+            if not sequential:
+                self.window = 0
+                self.prefetched = -1
+                return []
+
+            self.window = min(max(self.window * 2, 1), self.max_window)
+            last = (offset + size - 1) // self.block_size
+            target = last + self.window
+            if length is not None:
+                target = min(target, (length - 1) // self.block_size)
+
+            first = max(self.prefetched + 1, last + 1)
+            self.prefetched = max(self.prefetched, target)
+            return range(first, target + 1)
+
+
+class Prefetcher(object):
+    '''
+    Pool of worker threads downloading blocks in the background. *fetch*
+    is called with a cache handle and a block index. A block already
+    queued is not queued again.
+    '''
+
+    def __init__(self, fetch, workers=PREFETCH_WORKERS):
+        self.fetch = fetch
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name='prefetch-%d' % number)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        '''
+        Ask workers to stop once queued blocks are processed.
+        '''
+        for thread in self.threads:
+            self.queue.put(None)
+        self.threads = []
+
+    def schedule(self, cache_handle, indexes):
+        '''
+        Queue download of given blocks of a binary revision.
+        '''
+        if len(self.threads) == 0:
+            return
+        with self.lock:
+            for index in indexes:
+                key = (cache_handle.binary_id, cache_handle.rev, index)
+                if key not in self.pending:
+                    self.pending.add(key)
+                    self.queue.put((key, cache_handle, index))
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+
+            (key, cache_handle, index) = task
+            try:
+                self.fetch(cache_handle, index)
+            except Exception:
+                logger.exception('[Prefetch] Cannot fetch block %d of %s' %
+                                 (index, cache_handle.binary_id))
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
@@ -0,0 +1,183 @@
+import os
+import time
+import base64
+import hashlib
+import tempfile
+import threading
+import logging
+
+import local_config
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+PROGRESS_STEP = 16 * 1024 * 1024
+
+
+class StagingFile(object):
+    '''
+    Local sparse file holding the content of an open file until it is saved
+    to the database. Writes land at their real offset, so memory usage does
+    not depend on the file size.
+    '''
+
+    def __init__(self, folder):
+        (fd, self.path) = tempfile.mkstemp(dir=folder, suffix='.staging')
+        self.file = os.fdopen(fd, 'w+b')
+        self.size = 0
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def write(self, buf, offset):
+        '''
+        Write *buf* at *offset*. Writing after the end of the file leaves a
+        hole that reads as zeros.
+        '''
+        with self.lock:
+            self.file.seek(offset)
+            self.file.write(buf)
+            self.size = max(self.size, offset + len(buf))
+            self.dirty = True
+        return len(buf)
+
+    def read(self, size, offset):
+        '''
+        Return *size* bytes starting at *offset*.
+        '''
+        with self.lock:
+            if offset >= self.size:
+                return ''
+            self.file.flush()
+            self.file.seek(offset)
+            return self.file.read(min(size, self.size - offset))
+
+    def stream(self, name=None):
+        '''
+        Return a file-like object reading staged content from the beginning,
+        suitable for a chunked upload.
+        '''
+        with self.lock:
+            self.file.flush()
+            return UploadStream(open(self.path, 'rb'), self.size, name)
+
+    def truncate(self, size):
+        '''
+        Shrink or extend staged content to *size* bytes.
+        '''
+        with self.lock:
+            self.file.flush()
+            self.file.truncate(size)
+            self.size = size
+            self.dirty = True
+
+    def digest(self):
+        '''
+        Return MD5 digest of staged content, in CouchDB attachment digest
+        format (md5-<base64 digest>).
+        '''
+        return stream_digest(self.stream())
+
+    def sync(self):
+        '''
+        Flush staged content to disk.
+        '''
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def move(self, path):
+        '''
+        Close the file and move it to *path*. Content should be synced
+        first. The staging file cannot be used afterwards.
+        '''
+        with self.lock:
+            self.file.close()
+            os.rename(self.path, path)
+            self.path = path
+
+    def remove(self):
+        '''
+        Close and delete the staging file.
+        '''
+        with self.lock:
+            self.file.close()
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+
+
+class UploadStream(object):
+    '''
+    File-like wrapper used as request body of an upload. Reads are bounded
+    to *chunk_size* bytes so only one chunk is held in memory, and sent
+    bytes are counted to report progress and throughput.
+    '''
+
+    def __init__(self, source, total, name=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.source = source
+        self.total = total
+        self.name = name
+        self.chunk_size = chunk_size
+        self.sent = 0
+        self.start = time.time()
+        self.next_report = PROGRESS_STEP
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        chunk = self.source.read(size)
+        self.sent += len(chunk)
+
+        if self.sent >= self.next_report:
+            logger.info('[Upload] %s: %d/%d bytes (%d%%, %.1f KB/s)' %
+                        (self.name, self.sent, self.total, self.progress(),
+                         self.throughput() / 1024))
+            self.next_report += PROGRESS_STEP
+        return chunk
+
+    def progress(self):
+        '''
+        Return percentage of content already read.
+        '''
+        if self.total == 0:
+            return 100
+        return self.sent * 100 / self.total
+
+    def throughput(self):
+        '''
+        Return average upload speed in bytes per second.
+        '''
+        elapsed = time.time() - self.start
+        if elapsed <= 0:
+            return 0.
+        return self.sent / elapsed
+
+    def close(self):
+        self.source.close()
+
+
+def stream_digest(stream):
+    '''
+    Return MD5 digest of the content of given upload stream, in CouchDB
+    attachment digest format (md5-<base64 digest>). The stream is closed.
+    '''
+    md5 = hashlib.md5()
+    try:
+        chunk = stream.read()
+        while chunk:
+            md5.update(chunk)
+            chunk = stream.read()
+    finally:
+        stream.close()
+    return 'md5-%s' % base64.b64encode(md5.digest())
+
+
+def clear_folder(folder):
+    '''
+    Remove staging files left by a previous mount.
+    '''
+    for filename in os.listdir(folder):
+        if filename.endswith('.staging'):
+            logger.info('[Staging] Remove leftover file %s' % filename)
+            os.remove(os.path.join(folder, filename))
@@ -0,0 +1,164 @@
+import time
+import Queue
+import threading
+import logging
+
+import local_config
+from cache import download
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+FLUSH_DELAY = 60
+IDLE_DELAY = 0.5
+
+
+class AccessLog(object):
+    '''
+    File opens not saved to the access history yet: number of opens and
+    last open time by file document id.
+    '''
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def record(self, doc_id):
+        with self.lock:
+            (count, last) = self.pending.get(doc_id, (0, 0))
+            self.pending[doc_id] = (count + 1, time.time())
+
+    def flush(self, store):
+        '''
+        Save pending accesses to the metadata store.
+        '''
+        with self.lock:
+            (pending, self.pending) = (self.pending, {})
+        if len(pending) > 0:
+            store.record_accesses(pending)
+
+
+class ForegroundGate(object):
+    '''
+    Track reads made by file system users, so background downloads can
+    wait for them to end.
+    '''
+
+    def __init__(self, idle_delay=IDLE_DELAY):
+        self.idle_delay = idle_delay
+        self.active = 0
+        self.last = 0
+        self.condition = threading.Condition()
+
+    def enter(self):
+        with self.condition:
+            self.active += 1
+
+    def leave(self):
+        with self.condition:
+            self.active -= 1
+            self.last = time.time()
+            self.condition.notify_all()
+
+    def wait_idle(self):
+        '''
+        Block until no read is running and none ran for *idle_delay*
+        seconds.
+        '''
+        with self.condition:
+            while True:
+                if self.active > 0:
+                    self.condition.wait(self.idle_delay)
+                    continue
+                remaining = self.last + self.idle_delay - time.time()
+                if remaining <= 0:
+                    return
+                self.condition.wait(remaining)
+
+
+class Warmer(threading.Thread):
+    '''
+    Background thread filling the block cache with the most opened files
+    of the access history when the file system is mounted, with *workers*
+    downloads at a time. Downloads pause while users read files. Once the
+    warmup is done, the thread saves the access log to the store every
+    FLUSH_DELAY seconds.
+    '''
+
+    def __init__(self, store, access_log, get_file, cache, fetch, gate,
+                 count, workers):
+        threading.Thread.__init__(self, name='warmer')
+        self.daemon = True
+        self.store = store
+        self.access_log = access_log
+        self.get_file = get_file
+        self.cache = cache
+        self.fetch = fetch
+        self.gate = gate
+        self.count = count
+        self.workers = workers
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            self.warmup()
+        except Exception:
+            logger.exception('[Warmup] Cannot warm cache up')
+
+        while not self.stopped.wait(FLUSH_DELAY):
+            self.flush()
+
+    def warmup(self):
+        '''
+        Download missing blocks of the most opened files.
+        '''
+        if self.count <= 0:
+            return
+
+        queue = Queue.Queue()
+        for doc_id in self.store.get_hot_files(self.count):
+            queue.put(doc_id)
+        logger.info('[Warmup] Warming %d files up' % queue.qsize())
+
+        threads = []
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, args=(queue,),
+                                      name='warmer-%d' % number)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        logger.info('[Warmup] Done')
+
+    def _work(self, queue):
+        while not self.stopped.is_set():
+            try:
+                doc_id = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                doc = self.get_file(doc_id)
+                if doc is None or 'binary' not in doc:
+                    continue
+                binary = doc['binary']['file']
+                download(self.cache, self.fetch, binary['id'],
+                         binary.get('rev'), doc.get('size', 0),
+                         self.stopped, self.gate.wait_idle)
+            except Exception:
+                logger.exception('[Warmup] Cannot warm %s up' % doc_id)
+
+    def flush(self):
+        try:
+            self.access_log.flush(self.store)
+        except Exception:
+            logger.exception('[Warmup] Cannot save access log')
+
+    def stop(self):
+        '''
+        Stop downloads and save the access log.
+        '''
+        self.stopped.set()
+        self.flush()
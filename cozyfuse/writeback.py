@@ -0,0 +1,315 @@
+import os
+import json
+import errno
+import time
+import urllib
+import threading
+import logging
+
+import local_config
+from staging import UploadStream, stream_digest
+
+logger = logging.getLogger(__name__)
+local_config.configure_logger(logger)
+
+
+RETRY_DELAY = 10
+
+
+class WriteBackEntry(object):
+    '''
+    Saved file waiting to be uploaded: ids of its documents, path (for
+    logs), content and queue times.
+    '''
+
+    def __init__(self, doc_id, binary_id, path, content, queued=None,
+                 updated=None):
+        self.doc_id = doc_id
+        self.binary_id = binary_id
+        self.path = path
+        self.content = content
+        self.queued = queued or time.time()
+        self.updated = updated or time.time()
+        self.attempts = 0
+
+    def to_json(self):
+        return {
+            'doc_id': self.doc_id,
+            'binary_id': self.binary_id,
+            'path': self.path,
+            'data': os.path.basename(self.content.path),
+            'size': self.content.size,
+            'queued': self.queued,
+            'updated': self.updated,
+        }
+
+
+class QueuedContent(object):
+    '''
+    Content of a queue entry, read from its data file. The file is opened
+    on each access, so queued entries do not hold file descriptors.
+    '''
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def read(self, size, offset):
+        '''
+        Return *size* bytes starting at *offset*, None if the entry left
+        the queue (uploaded, saved again or dropped).
+        '''
+        if offset >= self.size:
+            return ''
+        try:
+            with open(self.path, 'rb') as data_file:
+                data_file.seek(offset)
+                return data_file.read(min(size, self.size - offset))
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def stream(self, name=None):
+        '''
+        Return a file-like object reading the content from the beginning,
+        suitable for a chunked upload.
+        '''
+        return UploadStream(open(self.path, 'rb'), self.size, name)
+
+    def digest(self):
+        return stream_digest(self.stream())
+
+
+class WriteBackQueue(object):
+    '''
+    Durable queue of saved files waiting to be uploaded to the database.
+    Each entry is stored in *folder* as a data file holding the content
+    and a journal file describing it, named after the file document id.
+    Saving a file already queued replaces its entry, so successive saves
+    are uploaded once. Entries are reloaded from the folder on mount.
+    '''
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.entries = {}
+        self.condition = threading.Condition()
+        self._load()
+
+    def push(self, doc_id, binary_id, path, staged):
+        '''
+        Queue content of *staged* (a staging file, closed and moved to the
+        queue folder) as new content of given file. Content must be synced
+        to disk first (see StagingFile.sync), the queue is locked only to
+        move it and write the journal.
+        '''
+        with self.condition:
+            staged.move(os.path.join(self.folder,
+                                     os.path.basename(staged.path)))
+            content = QueuedContent(staged.path, staged.size)
+
+            previous = self.entries.get(doc_id)
+            entry = WriteBackEntry(doc_id, binary_id, path, content)
+            if previous is not None:
+                entry.queued = previous.queued
+                logger.info('[WriteBack] %s saved again, uploads merged' %
+                            path)
+
+            _write_journal(self._journal_path(doc_id), entry.to_json())
+            self.entries[doc_id] = entry
+            self.condition.notify_all()
+        if previous is not None:
+            _remove_file(previous.content.path)
+        return entry
+
+    def get_content(self, doc_id):
+        '''
+        Return content of given file waiting to be uploaded, None if there
+        is none.
+        '''
+        with self.condition:
+            entry = self.entries.get(doc_id)
+            if entry is None:
+                return None
+            return entry.content
+
+    def next(self, timeout=None):
+        '''
+        Return oldest entry of the queue. Wait up to *timeout* seconds for
+        an entry if the queue is empty, then return None.
+        '''
+        with self.condition:
+            if len(self.entries) == 0:
+                self.condition.wait(timeout)
+            if len(self.entries) == 0:
+                return None
+            return min(self.entries.values(),
+                       key=lambda entry: entry.queued)
+
+    def is_queued(self, entry):
+        '''
+        Return False if given entry was replaced by a new save or dropped.
+        '''
+        with self.condition:
+            return self.entries.get(entry.doc_id) is entry
+
+    def complete(self, entry):
+        '''
+        Remove uploaded entry from the queue. Nothing is removed if the
+        file was saved again during the upload.
+        '''
+        with self.condition:
+            if self.entries.get(entry.doc_id) is entry:
+                self._remove(entry.doc_id)
+
+    def discard(self, doc_id):
+        '''
+        Drop queued content of given file, when it is deleted.
+        '''
+        with self.condition:
+            if doc_id in self.entries:
+                self._remove(doc_id)
+
+    def stats(self):
+        '''
+        Return number of queued files, their total size and the age of the
+        oldest one in seconds.
+        '''
+        with self.condition:
+            return _get_stats([entry.to_json()
+                               for entry in self.entries.values()])
+
+    def _remove(self, doc_id):
+        entry = self.entries.pop(doc_id)
+        _remove_file(self._journal_path(doc_id))
+        _remove_file(entry.content.path)
+
+    def _load(self):
+        '''
+        Reload entries left by a previous mount. Files that no journal
+        refers to (interrupted saves) are removed.
+        '''
+        filenames = os.listdir(self.folder)
+        for filename in filenames:
+            if not filename.endswith('.json'):
+                continue
+
+            path = os.path.join(self.folder, filename)
+            try:
+                with open(path) as journal_file:
+                    data = json.load(journal_file)
+                data_path = os.path.join(self.folder, data['data'])
+                content = QueuedContent(data_path,
+                                        os.path.getsize(data_path))
+            except (IOError, OSError, ValueError, KeyError):
+                logger.warn('[WriteBack] Corrupted entry %s removed' %
+                            filename)
+                os.remove(path)
+                continue
+
+            self.entries[data['doc_id']] = WriteBackEntry(
+                data['doc_id'], data['binary_id'], data['path'], content,
+                data['queued'], data['updated'])
+
+        used = set([os.path.basename(entry.content.path)
+                    for entry in self.entries.values()])
+        for filename in filenames:
+            if not filename.endswith('.json') and filename not in used:
+                _remove_file(os.path.join(self.folder, filename))
+
+        if len(self.entries) > 0:
+            logger.info('[WriteBack] %d files waiting for upload' %
+                        len(self.entries))
+
+    def _journal_path(self, doc_id):
+        return os.path.join(self.folder, '%s.json' % _get_name(doc_id))
+
+
+class Uploader(threading.Thread):
+    '''
+    Background thread uploading entries of the write-back queue, oldest
+    first, with *upload*. Failed uploads are retried after RETRY_DELAY
+    seconds.
+    '''
+
+    def __init__(self, queue, upload):
+        threading.Thread.__init__(self, name='uploader')
+        self.daemon = True
+        self.queue = queue
+        self.upload = upload
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            entry = self.queue.next(timeout=1)
+            if entry is None:
+                continue
+
+            try:
+                self.upload(entry)
+                self.queue.complete(entry)
+                stats = self.queue.stats()
+                logger.info('[WriteBack] %s uploaded, %d files waiting '
+                            '(oldest: %ds)' %
+                            (entry.path, stats['depth'], stats['age']))
+            except Exception:
+                # Content of a replaced entry is removed while it uploads.
+                if not self.queue.is_queued(entry):
+                    continue
+                entry.attempts += 1
+                logger.exception('[WriteBack] Cannot upload %s (attempt %d)'
+                                 % (entry.path, entry.attempts))
+                self.stopped.wait(RETRY_DELAY)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def read_status(folder):
+    '''
+    Return queue statistics from the journal files of given queue folder,
+    without loading the queue.
+    '''
+    journals = []
+    for filename in os.listdir(folder):
+        if filename.endswith('.json'):
+            try:
+                with open(os.path.join(folder, filename)) as journal_file:
+                    journals.append(json.load(journal_file))
+            except (IOError, ValueError):
+                continue
+    return _get_stats(journals)
+
+
+def _get_stats(journals):
+    now = time.time()
+    oldest = min([journal['queued'] for journal in journals] or [now])
+    return {
+        'depth': len(journals),
+        'bytes': sum([journal['size'] for journal in journals]),
+        'age': int(now - oldest),
+    }
+
+
+def _get_name(doc_id):
+    if isinstance(doc_id, unicode):
+        doc_id = doc_id.encode('utf-8')
+    return urllib.quote(doc_id, safe='')
+
+
+def _remove_file(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def _write_journal(path, data):
+    '''
+    Write journal file atomically: data are synced to a temporary file
+    that replaces the journal.
+    '''
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as journal_file:
+        json.dump(data, journal_file)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.rename(tmp_path, path)
@@ -0,0 +1,168 @@
+import sys
+import os
+import shutil
+import pytest
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+import cozyfuse.cache as cache
+
+CACHE_FOLDER = os.path.join(local_config.CONFIG_FOLDER, 'cache-test')
+
+
+@pytest.fixture
+def block_cache(request):
+    if os.path.isdir(CACHE_FOLDER):
+        shutil.rmtree(CACHE_FOLDER)
+
+    def fin():
+        shutil.rmtree(CACHE_FOLDER)
+    request.addfinalizer(fin)
+
+    return cache.BlockCache(CACHE_FOLDER, max_size=40, block_size=4)
+
+
+def test_read_missing(block_cache):
+    assert block_cache.read('binary', '1-a', 0, 4) is None
+
+
+def test_store_and_read(block_cache):
+    block_cache.store('binary', '1-a', 0, 'abcdefghij', length=10)
+    assert block_cache.read('binary', '1-a', 2, 4) == 'cdef'
+    assert block_cache.read('binary', '1-a', 8, 10) == 'ij'
+    assert block_cache.read('binary', '1-a', 12, 4) == ''
+
+
+def test_partial_store(block_cache):
+    block_cache.store('binary', '1-a', 4, 'efgh', length=10)
+    assert block_cache.read('binary', '1-a', 4, 4) == 'efgh'
+    assert block_cache.read('binary', '1-a', 0, 4) is None
+
+
+def test_revision_change(block_cache):
+    block_cache.store('binary', '1-a', 0, 'abcd', length=4)
+    assert block_cache.read('binary', '2-b', 0, 4) is None
+    assert block_cache.read('binary', '1-a', 0, 4) is None
+
+
+def test_persistence(block_cache):
+    block_cache.store('binary', '1-a', 0, 'abcdefgh', length=8)
+    reloaded = cache.BlockCache(CACHE_FOLDER, max_size=40, block_size=4)
+    assert reloaded.read('binary', '1-a', 0, 8) == 'abcdefgh'
+    assert reloaded.size == 8
+
+
+def test_eviction(block_cache):
+    block_cache.store('binary1', '1-a', 0, 'a' * 24, length=24)
+    block_cache.store('binary2', '1-a', 0, 'b' * 24, length=24)
+    assert block_cache.read('binary1', '1-a', 0, 4) is None
+    assert block_cache.read('binary2', '1-a', 0, 4) == 'bbbb'
+    assert block_cache.size <= 40
+
+
+def test_handle(block_cache):
+    handle = block_cache.handle('binary', '1-a')
+    handle.store(0, 'abcd', length=4)
+    assert str(handle.read(1, 2)) == 'bc'
+    assert block_cache.handle('binary', '2-b').read(0, 4) is None
+
+
+def test_contains(block_cache):
+    block_cache.store('binary', '1-a', 0, 'abcdef', length=6)
+    assert block_cache.contains('binary', '1-a', 4, 4)
+    assert block_cache.contains('binary', '1-a', 8, 4)
+    assert not block_cache.contains('other', '1-a', 0, 4)
+
+
+def test_read_after_new_revision(block_cache):
+    block_cache.store('binary', '1-a', 0, 'abcdefghij', length=10)
+    data_file = open(block_cache._data_path('binary'), 'rb')
+    # A newer revision replaces the data file, not its content.
+    block_cache.store('binary', '2-b', 0, 'ABCDEFGHIJ', length=10)
+    assert data_file.read() == 'abcdefghij'
+    data_file.close()
+    assert block_cache.read('binary', '2-b', 0, 4) == 'ABCD'
+
+
+def test_handle_mapped(block_cache):
+    handle = block_cache.handle('binary', '1-a')
+    handle.store(0, 'abcd', length=10)
+    assert handle.read(0, 2) == 'ab'
+    assert handle.mapped is None
+
+    handle.store(4, 'efghij', length=10)
+    buf = handle.read(2, 4)
+    assert isinstance(buf, buffer)
+    assert str(buf) == 'cdef'
+    assert str(handle.read(8, 4)) == 'ij'
+    assert str(handle.read(12, 4)) == ''
+    handle.close()
+    assert handle.mapped is None
+
+
+def test_handle_mapped_hits(block_cache, monkeypatch):
+    monkeypatch.setattr(cache, 'TOUCH_STEP', 2)
+    handle = block_cache.handle('binary', '1-a')
+    handle.store(0, 'abcdefghij', length=10)
+    handle.read(0, 4)
+    entry = block_cache.entries['binary']
+    hits = entry.hits
+    entry.atime = 0
+
+    # Both mapped reads are reported on the second one.
+    handle.read(4, 4)
+    assert entry.hits == hits + 2
+    assert entry.atime > 0
+    handle.read(0, 4)
+    handle.close()
+    assert entry.hits == hits + 3
+    assert block_cache.stats()['hits'] == entry.hits
+
+
+def test_stats(block_cache):
+    block_cache.read('binary', '1-a', 0, 4)
+    block_cache.store('binary', '1-a', 0, 'abcd', length=4)
+    block_cache.read('binary', '1-a', 0, 4)
+    stats = block_cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['size'] == 4
+
+
+def test_eviction_protects_open_and_pinned(block_cache):
+    handle = block_cache.handle('binary1', '1-a')
+    handle.store(0, 'a' * 16, length=16)
+    block_cache.store('binary2', '1-a', 0, 'b' * 16, length=16)
+    block_cache.pin('binary2')
+    block_cache.store('binary3', '1-a', 0, 'c' * 16, length=16)
+    assert block_cache.contains('binary1', '1-a', 0, 16)
+    assert block_cache.contains('binary2', '1-a', 0, 16)
+    assert block_cache.size == 48
+
+    handle.close()
+    block_cache.unpin('binary2')
+    block_cache.store('binary4', '1-a', 0, 'd' * 4, length=4)
+    assert block_cache.size <= 40
+    assert block_cache.stats()['evictions'] == 1
+
+
+def test_lfu_policy(request):
+    if os.path.isdir(CACHE_FOLDER):
+        shutil.rmtree(CACHE_FOLDER)
+    request.addfinalizer(lambda: shutil.rmtree(CACHE_FOLDER))
+    lfu_cache = cache.BlockCache(CACHE_FOLDER, max_size=40, block_size=4,
+                                 policy='lfu')
+    lfu_cache.store('binary1', '1-a', 0, 'a' * 16, length=16)
+    lfu_cache.store('binary2', '1-a', 0, 'b' * 16, length=16)
+    lfu_cache.read('binary1', '1-a', 0, 4)
+    lfu_cache.read('binary1', '1-a', 0, 4)
+    lfu_cache.store('binary3', '1-a', 0, 'c' * 16, length=16)
+    assert lfu_cache.contains('binary1', '1-a', 0, 16)
+    assert not lfu_cache.contains('binary2', '1-a', 0, 16)
@@ -0,0 +1,290 @@
+import sys
+import os
+import copy
+import types
+import errno
+import base64
+import shutil
+import hashlib
+import threading
+import pytest
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+# fuse-python is only needed to mount: the file system is tested through
+# its methods, with a stub module when it is not installed.
+try:
+    import fuse
+except ImportError:
+    fuse = types.ModuleType('fuse')
+    fuse.Stat = object
+    fuse.Fuse = object
+    sys.modules['fuse'] = fuse
+
+# The mount log is written in the real configuration folder.
+LOG_FOLDER = os.path.join(os.path.expanduser('~'), '.cozyfuse')
+if not os.path.isdir(LOG_FOLDER):
+    os.makedirs(LOG_FOLDER)
+
+import cozyfuse.dbutils as dbutils
+import cozyfuse.couchmount as couchmount
+from cozyfuse.cache import BlockCache
+from cozyfuse.inodes import InodeTable
+from cozyfuse.pathindex import PathIndex, NegativeCache
+from cozyfuse.prefetch import Prefetcher
+from cozyfuse.warmup import AccessLog, ForegroundGate
+from cozyfuse.writeback import WriteBackQueue
+from couchdb.client import Document
+from couchdb.http import ResourceNotFound
+
+TEST_FOLDER = os.path.join(local_config.CONFIG_FOLDER, 'couchmount-test')
+
+
+def get_digest(content):
+    return 'md5-%s' % base64.b64encode(hashlib.md5(content).digest())
+
+
+class FakeDB(object):
+    '''
+    In-memory database supporting the document and attachment calls made
+    by the file system.
+    '''
+
+    def __init__(self):
+        self.docs = {}
+        self.contents = {}
+        self.saves = []
+        self.uploads = []
+        self.on_upload = None
+
+    def add(self, doc, content=None):
+        if content is not None:
+            doc['_attachments'] = {'file': {'length': len(content),
+                                            'digest': get_digest(content)}}
+            self.contents[doc['_id']] = content
+        self.docs[doc['_id']] = doc
+
+    def __getitem__(self, doc_id):
+        if doc_id not in self.docs:
+            raise ResourceNotFound()
+        return Document(copy.deepcopy(self.docs[doc_id]))
+
+    def get(self, doc_id):
+        if doc_id not in self.docs:
+            return None
+        return self[doc_id]
+
+    def save(self, doc):
+        self.saves.append(doc['_id'])
+        doc['_rev'] = _next_rev(self.docs[doc['_id']]['_rev'])
+        self.docs[doc['_id']] = copy.deepcopy(dict(doc))
+
+    def put_attachment(self, doc, content, filename=None):
+        data = ''
+        chunk = content.read()
+        while chunk:
+            data += chunk
+            chunk = content.read()
+        if self.on_upload is not None:
+            self.on_upload()
+        self.uploads.append(data)
+
+        stored = self.docs[doc['_id']]
+        stored['_rev'] = _next_rev(stored['_rev'])
+        self.add(stored, data)
+        doc['_rev'] = stored['_rev']
+
+
+def _next_rev(rev):
+    return '%d-x' % (int(rev.split('-')[0]) + 1)
+
+
+@pytest.fixture
+def fs(request):
+    if os.path.isdir(TEST_FOLDER):
+        shutil.rmtree(TEST_FOLDER)
+    folders = {}
+    for name in ('cache', 'staging', 'writeback'):
+        folders[name] = os.path.join(TEST_FOLDER, name)
+        os.makedirs(folders[name])
+
+    db = FakeDB()
+    db.add({'_id': 'binary1', '_rev': '1-a', 'docType': 'Binary'}, 'stored')
+    db.add({'_id': 'file1', '_rev': '1-b', 'docType': 'File',
+            'path': '/docs', 'name': 'a.txt', 'size': 6,
+            'binary': {'file': {'id': 'binary1', 'rev': '1-a'}}})
+
+    fs = couchmount.CouchFSDocument.__new__(couchmount.CouchFSDocument)
+    fs.db = db
+    fs.http_session = None
+    fs.mount_config = {'readahead': 0}
+    fs.index = PathIndex()
+    fs.index.add_doc(db.docs['file1'])
+    fs.index.entries(u'/docs')
+    fs.negative = NegativeCache()
+    fs.open_files = {}
+    fs.kernel_revs = {}
+    fs.files_lock = threading.Lock()
+    fs.cache = BlockCache(folders['cache'], block_size=4)
+    fs.staging_folder = folders['staging']
+    fs.writeback = WriteBackQueue(folders['writeback'])
+    fs.prefetcher = Prefetcher(fs._prefetch, 0)
+    fs.access_log = AccessLog()
+    fs.foreground = ForegroundGate()
+    fs.inodes = InodeTable(os.path.join(TEST_FOLDER, 'inodes'))
+
+    def fin():
+        fs.inodes.close()
+        shutil.rmtree(TEST_FOLDER)
+    request.addfinalizer(fin)
+    return fs
+
+
+def open_file(fs, path=u'/docs/a.txt'):
+    file_class = type('CouchFile', (couchmount.CouchFile,), {'fs': fs})
+    return file_class(path, os.O_RDWR)
+
+
+def queue(fs, content, doc_id='file1'):
+    staged = couchmount.staging.StagingFile(fs.staging_folder)
+    staged.write(content, 0)
+    staged.sync()
+    return fs.writeback.push(doc_id, 'binary1', u'/docs/a.txt', staged)
+
+
+def store(fs, content='stored'):
+    fs.cache.store('binary1', '1-a', 0, content, length=len(content))
+
+
+def test_release_queues_written_content(fs):
+    store(fs)
+    handle = open_file(fs)
+    assert handle.write('new', 6) == 3
+    assert fs.getattr(u'/docs/a.txt').st_size == 9
+    assert handle.release(0) == 0
+
+    assert fs.open_files == {}
+    assert fs.db.uploads == []
+    content = fs.writeback.get_content('file1')
+    assert content.read(20, 0) == 'storednew'
+    assert os.listdir(fs.staging_folder) == []
+    assert fs.getattr(u'/docs/a.txt').st_size == 9
+
+
+def test_release_unmodified(fs):
+    store(fs)
+    handle = open_file(fs)
+    assert str(handle.read(6, 0)) == 'stored'
+    handle.release(0)
+    assert fs.writeback.stats()['depth'] == 0
+
+
+def test_keep_cache(fs):
+    store(fs)
+    handle = open_file(fs)
+    assert not handle.keep_cache
+    handle.release(0)
+    handle = open_file(fs)
+    assert handle.keep_cache
+    handle.release(0)
+
+    # Queued content is not kept by the kernel, nor the uploaded one.
+    queue(fs, 'queued')
+    handle = open_file(fs)
+    assert not handle.keep_cache
+    handle.release(0)
+    fs._upload_entry(fs.writeback.next())
+    fs.writeback.complete(fs.writeback.next())
+    handle = open_file(fs)
+    assert not handle.keep_cache
+    handle.release(0)
+
+
+def test_upload(fs):
+    entry = queue(fs, 'uploaded')
+    fs._upload_entry(entry)
+    assert fs.db.uploads == ['uploaded']
+    file_doc = fs.db.docs['file1']
+    assert file_doc['size'] == 8
+    assert file_doc['binary']['file']['rev'] == fs.db.docs['binary1']['_rev']
+    assert fs.index.lookup(u'/docs/a.txt').size == 8
+
+
+def test_redundant_upload_saves_file_doc(fs):
+    # Attachment was uploaded but the file document was not saved.
+    fs.db.add(fs.db.docs['binary1'], 'uploaded')
+    fs.db.docs['binary1']['_rev'] = '2-a'
+    entry = queue(fs, 'uploaded')
+
+    fs._upload_entry(entry)
+    assert fs.db.uploads == []
+    file_doc = fs.db.docs['file1']
+    assert file_doc['size'] == 8
+    assert file_doc['binary']['file']['rev'] == '2-a'
+
+    # Nothing is written once the file document matches.
+    fs._upload_entry(entry)
+    assert fs.db.saves == ['file1']
+
+
+def test_upload_deleted_file(fs):
+    entry = queue(fs, 'uploaded')
+    del fs.db.docs['file1']
+    fs._upload_entry(entry)
+    assert fs.db.uploads == []
+
+
+def test_save_during_upload(fs):
+    first = queue(fs, 'first')
+
+    def save_again():
+        handle = open_file(fs)
+        assert handle.read(5, 0) == 'first'
+        handle.write('second', 0)
+        handle.release(0)
+    fs.db.on_upload = save_again
+
+    fs._upload_entry(first)
+    fs.writeback.complete(first)
+    assert fs.db.uploads == ['first']
+
+    second = fs.writeback.next()
+    assert second is not first
+    assert second.queued == first.queued
+    assert second.content.read(10, 0) == 'second'
+
+    fs.db.on_upload = None
+    fs._upload_entry(second)
+    fs.writeback.complete(second)
+    assert fs.db.uploads == ['first', 'second']
+    assert fs.writeback.stats()['depth'] == 0
+
+
+def test_stage_queued_content(fs):
+    store(fs)
+    queue(fs, 'queued content')
+    handle = open_file(fs)
+    assert handle.read(20, 0) == 'queued content'
+
+    handle.write('Q', 0)
+    assert handle.read(20, 0) == 'Queued content'
+    handle.release(0)
+    assert fs.writeback.get_content('file1').read(20, 0) == 'Queued content'
+
+
+def test_stage_missing_revision(fs, monkeypatch):
+    monkeypatch.setattr(dbutils, 'get_attachment_range',
+                        lambda *args, **kwargs: None)
+    handle = open_file(fs)
+    assert handle.read(4, 0) == -errno.EAGAIN
+    assert handle.write('new', 6) == -errno.EIO
+    assert os.listdir(fs.staging_folder) == []
+    handle.release(0)
+    assert fs.writeback.stats()['depth'] == 0
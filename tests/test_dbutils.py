@@ -1,7 +1,9 @@
 import pytest
 import sys
 import os
+import json
 import requests
+import httpretty
 
 sys.path.append('..')
 
@@ -14,6 +16,7 @@ local_config.CONFIG_PATH = \
 
 
 import cozyfuse.dbutils as dbutils
+from couchdb import Database
 
 TESTDB = 'cozy-fuse-test'
 
@@ -102,6 +105,234 @@ def get_device():
     db.create(device)
 
 
+def test_get_attachment_range():
+    httpretty.enable()
+    url = 'http://localhost:5984/%s/binaryid/file' % TESTDB
+    httpretty.register_uri(httpretty.GET, url, body='abcd', status=206,
+                           adding_headers={'Content-Range': 'bytes 4-7/10'})
+    db = Database('http://localhost:5984/%s' % TESTDB)
+    result = dbutils.get_attachment_range(db, 'binaryid', 4, 7)
+    assert result == (4, 'abcd', 10)
+    assert httpretty.last_request().headers['Range'] == 'bytes=4-7'
+    assert httpretty.last_request().querystring == {}
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_attachment_range_rev():
+    httpretty.enable()
+    url = 'http://localhost:5984/%s/binaryid/file' % TESTDB
+    httpretty.register_uri(httpretty.GET, url, body='abcd', status=206,
+                           adding_headers={'Content-Range': 'bytes 4-7/10'})
+    db = Database('http://localhost:5984/%s' % TESTDB)
+    result = dbutils.get_attachment_range(db, 'binaryid', 4, 7, rev='2-abc')
+    assert result == (4, 'abcd', 10)
+    assert httpretty.last_request().querystring == {'rev': ['2-abc']}
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_attachment_range_ignored():
+    httpretty.enable()
+    url = 'http://localhost:5984/%s/binaryid/file' % TESTDB
+    httpretty.register_uri(httpretty.GET, url, body='abcdefghij')
+    db = Database('http://localhost:5984/%s' % TESTDB)
+    result = dbutils.get_attachment_range(db, 'binaryid', 4, 7)
+    assert result == (0, 'abcdefghij', 10)
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_create_file():
+    httpretty.enable()
+    url = 'http://localhost:5984/%s/_bulk_docs' % TESTDB
+    httpretty.register_uri(httpretty.POST, url, body='[]', status=201,
+                           content_type='application/json')
+    db = Database('http://localhost:5984/%s' % TESTDB)
+    file_doc = dbutils.create_file(db, '/docs', 'a.txt', 'hello')
+
+    body = json.loads(httpretty.last_request().body)
+    assert body['new_edits'] is False
+    (binary, saved_file) = body['docs']
+    assert binary['docType'] == 'Binary'
+    assert binary['_attachments']['file']['data'] == 'aGVsbG8='
+    assert saved_file == file_doc
+    assert file_doc['binary']['file'] == {'id': binary['_id'],
+                                          'rev': binary['_rev']}
+    assert file_doc['size'] == 5
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_file_stats():
+    httpretty.enable()
+    url = 'http://localhost:5984/%s/_design/file/_view/stats' % TESTDB
+    body = {'rows': [{'key': None, 'value': {'sum': 1536.0, 'count': 3,
+                                              'min': 0, 'max': 1024,
+                                              'sumsqr': 1310720}}]}
+    httpretty.register_uri(httpretty.GET, url, body=json.dumps(body),
+                           content_type='application/json')
+    db = Database('http://localhost:5984/%s' % TESTDB)
+    assert dbutils.get_file_stats(db) == (1536, 3)
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_docs_by_full_path():
+    httpretty.enable()
+    url = 'http://localhost:5984/%s/_design/folder/_view/byFullPath' % TESTDB
+    body = {'rows': [{'key': '/docs', 'value': {'_id': 'folder1',
+                                                 'name': 'docs'}}]}
+    httpretty.register_uri(httpretty.POST, url, body=json.dumps(body),
+                           content_type='application/json')
+    db = Database('http://localhost:5984/%s' % TESTDB)
+    docs = dbutils.get_docs_by_full_path(db, 'folder', ['/docs', '/other'])
+    assert docs == [{'_id': 'folder1', 'name': 'docs'}]
+    request_body = json.loads(httpretty.last_request().body)
+    assert request_body == {'keys': ['/docs', '/other']}
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_folder_children(monkeypatch):
+    monkeypatch.setattr(dbutils, 'PAGE_SIZE', 1)
+    httpretty.enable()
+    db = Database('http://localhost:5984/%s' % TESTDB)
+
+    def rows(*ids):
+        return json.dumps({'rows': [
+            {'id': doc_id, 'key': '/docs', 'value': {'_id': doc_id}}
+            for doc_id in ids]})
+
+    url = 'http://localhost:5984/%s/_design/%s/_view/byFolder'
+    httpretty.register_uri(httpretty.GET, url % (TESTDB, 'folder'),
+                           body=rows(), content_type='application/json')
+    httpretty.register_uri(httpretty.GET, url % (TESTDB, 'file'),
+                           responses=[
+                               httpretty.Response(
+                                   body=rows('a', 'b'),
+                                   content_type='application/json'),
+                               httpretty.Response(
+                                   body=rows('b'),
+                                   content_type='application/json'),
+                           ])
+    docs = list(dbutils.get_folder_children(db, '/docs'))
+    assert [doc['_id'] for doc in docs] == ['a', 'b']
+    query = httpretty.last_request().querystring
+    assert query['startkey_docid'] == ['b']
+    httpretty.disable()
+    httpretty.reset()
+
+
+SUBTREE_DOCS = {
+    'folder': [
+        {'_id': 'sub', '_rev': '1-a', 'docType': 'Folder', 'path': '/docs',
+         'name': 'sub'},
+        {'_id': 'other', '_rev': '1-b', 'docType': 'Folder', 'path': '/docsx',
+         'name': 'other'},
+    ],
+    'file': [
+        {'_id': 'file1', '_rev': '1-c', 'docType': 'File',
+         'path': '/docs/sub', 'name': 'a.txt',
+         'binary': {'file': {'id': 'binary1', 'rev': '1-d'}}},
+        {'_id': 'file2', '_rev': '1-e', 'docType': 'File', 'path': '/docs',
+         'name': 'b.txt',
+         'binary': {'file': {'id': 'binary2', 'rev': '1-f'}}},
+    ],
+}
+
+
+def register_subtree():
+    url = 'http://localhost:5984/%s/_design/%s/_view/byFolder'
+    for doc_type in ('folder', 'file'):
+        rows = [{'id': doc['_id'], 'key': doc['path'], 'value': doc}
+                for doc in SUBTREE_DOCS[doc_type]]
+        httpretty.register_uri(httpretty.GET, url % (TESTDB, doc_type),
+                               body=json.dumps({'rows': rows}),
+                               content_type='application/json')
+
+
+def register_bulk_docs(failed=()):
+    bulks = []
+
+    def callback(request, uri, headers):
+        docs = json.loads(request.body)['docs']
+        bulks.append(docs)
+        result = []
+        for doc in docs:
+            if doc['_id'] in failed:
+                result.append({'id': doc['_id'], 'error': 'conflict',
+                               'reason': 'Document update conflict.'})
+            else:
+                result.append({'id': doc['_id'], 'rev': '2-x'})
+        return (201, headers, json.dumps(result))
+
+    httpretty.register_uri(httpretty.POST,
+                           'http://localhost:5984/%s/_bulk_docs' % TESTDB,
+                           body=callback, content_type='application/json')
+    return bulks
+
+
+def test_bulk_save(monkeypatch):
+    monkeypatch.setattr(dbutils, 'BULK_SIZE', 2)
+    httpretty.enable()
+    bulks = register_bulk_docs(failed=['c'])
+    db = Database('http://localhost:5984/%s' % TESTDB)
+
+    failed = dbutils.bulk_save(db, [{'_id': 'a'}, {'_id': 'b'}, {'_id': 'c'}])
+    assert failed == ['c']
+    assert [[doc['_id'] for doc in docs] for docs in bulks] == \
+        [['a', 'b'], ['c']]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_move_subtree():
+    httpretty.enable()
+    register_subtree()
+    bulks = register_bulk_docs()
+    db = Database('http://localhost:5984/%s' % TESTDB)
+    folder = {'_id': 'docs', '_rev': '1-g', 'docType': 'Folder', 'path': '',
+              'name': 'docs'}
+
+    replaced = [{'_id': 'old', '_rev': '1-o', '_deleted': True}]
+    failed = dbutils.move_subtree(db, folder, u'/docs', u'/archives/docs',
+                                  replaced)
+    assert failed == []
+    saved = dict((doc['_id'], doc) for doc in bulks[0])
+    assert sorted(saved.keys()) == ['docs', 'file1', 'file2', 'old', 'sub']
+    assert saved['old']['_deleted']
+    assert saved['sub']['path'] == '/archives/docs'
+    assert saved['file1']['path'] == '/archives/docs/sub'
+    assert saved['file2']['path'] == '/archives/docs'
+    assert (saved['docs']['path'], saved['docs']['name']) == \
+        ('/archives', 'docs')
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_deletion_stubs():
+    httpretty.enable()
+    httpretty.register_uri(
+        httpretty.POST, 'http://localhost:5984/%s/_all_docs' % TESTDB,
+        body=json.dumps({'rows': [
+            {'id': 'file1', 'key': 'file1', 'value': {'rev': '1-c'}},
+            {'id': 'binary1', 'key': 'binary1',
+             'value': {'rev': '2-h', 'deleted': True}},
+            {'key': 'missing', 'error': 'not_found'},
+        ]}), content_type='application/json')
+    db = Database('http://localhost:5984/%s' % TESTDB)
+
+    stubs = dbutils.get_deletion_stubs(db, ['file1', 'binary1', 'missing',
+                                            None])
+    assert stubs == [{'_id': 'file1', '_rev': '1-c', '_deleted': True}]
+    body = json.loads(httpretty.last_request().body)
+    assert body['keys'] == ['file1', 'binary1', 'missing']
+    assert dbutils.get_deletion_stubs(db, [None]) == []
+    httpretty.disable()
+    httpretty.reset()
+
+
 def init_db():
     pass
     # Not tested yet, because  I'm not sure it won't changed.
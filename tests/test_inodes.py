@@ -0,0 +1,64 @@
+import sys
+import os
+import shutil
+import pytest
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+import cozyfuse.inodes as inodes
+
+INODES_FOLDER = os.path.join(local_config.CONFIG_FOLDER, 'inodes-test')
+INODES_PATH = os.path.join(INODES_FOLDER, 'inodes')
+
+
+@pytest.fixture
+def table(request):
+    if os.path.isdir(INODES_FOLDER):
+        shutil.rmtree(INODES_FOLDER)
+    os.makedirs(INODES_FOLDER)
+
+    table = inodes.InodeTable(INODES_PATH)
+
+    def fin():
+        table.close()
+        shutil.rmtree(INODES_FOLDER)
+    request.addfinalizer(fin)
+
+    return table
+
+
+def test_root(table):
+    assert table.get(None) == inodes.ROOT_INODE
+
+
+def test_stable(table):
+    inode = table.get(u'docid')
+    assert inode == table.get('docid')
+    assert inode == inodes.derive_inode('docid')
+    assert inode != table.get(u'otherid')
+
+
+def test_collision(table, monkeypatch):
+    monkeypatch.setattr(inodes, 'derive_inode', lambda key: 42)
+    assert table.get('docid') == 42
+    assert table.get('otherid') == 43
+    assert table.get('docid') == 42
+
+
+def test_persistence(table, monkeypatch):
+    monkeypatch.setattr(inodes, 'derive_inode', lambda key: 42)
+    table.get('docid')
+    table.get('otherid')
+    table.close()
+
+    reloaded = inodes.InodeTable(INODES_PATH)
+    assert reloaded.get('otherid') == 43
+    assert reloaded.get('thirdid') == 44
+    reloaded.close()
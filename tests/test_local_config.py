@@ -68,12 +68,39 @@ def test_set_get_device_config(config_file):
     assert res == local_config.get_device_config('test-device')
 
 
+def test_get_mount_config(config_file):
+    config = local_config.get_mount_config('test-device')
+    assert config == local_config.MOUNT_DEFAULTS
+
+    full_config = local_config.get_full_config()
+    full_config['test-device']['mount'] = {'multithreaded': False}
+    with file(local_config.CONFIG_PATH, 'w') as output_file:
+        local_config.dump(full_config, output_file)
+    config = local_config.get_mount_config('test-device')
+    assert config['multithreaded'] is False
+    assert config['pool_size'] == local_config.MOUNT_DEFAULTS['pool_size']
+
+
+def test_pins(config_file):
+    assert local_config.get_pins('test-device') == []
+    local_config.set_pins('test-device', ['/photos', '/docs', '/docs'])
+    assert local_config.get_pins('test-device') == ['/docs', '/photos']
+    local_config.set_pins('test-device', [])
+
+
 def test_no_config(config_file):
     pytest.raises(local_config.NoConfigFound,
                   local_config.get_config,
                   'test-no-device')
 
 
+def test_get_device_folder(config_file):
+    folder = local_config.get_device_folder('test-device', 'cache')
+    assert folder == os.path.join(
+        local_config.CONFIG_FOLDER, 'test-device', 'cache')
+    assert os.path.isdir(folder)
+
+
 def test_clear_config(config_file):
     local_config.clear()
     assert False == os.path.isfile(local_config.CONFIG_PATH)
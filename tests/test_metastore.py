@@ -0,0 +1,96 @@
+import sys
+import os
+import shutil
+import pytest
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+import cozyfuse.metastore as metastore
+
+STORE_FOLDER = os.path.join(local_config.CONFIG_FOLDER, 'metastore-test')
+STORE_PATH = os.path.join(STORE_FOLDER, 'index.db')
+
+FOLDER = {'_id': 'folder1', 'docType': 'Folder', 'path': '', 'name': 'docs'}
+FILE = {'_id': 'file1', 'docType': 'File', 'path': '/docs', 'name': 'a.txt'}
+
+
+@pytest.fixture
+def store(request):
+    if os.path.isdir(STORE_FOLDER):
+        shutil.rmtree(STORE_FOLDER)
+    os.makedirs(STORE_FOLDER)
+    store = metastore.MetaStore(STORE_PATH)
+
+    def fin():
+        store.close()
+        shutil.rmtree(STORE_FOLDER)
+    request.addfinalizer(fin)
+
+    return store
+
+
+def test_seq(store):
+    assert store.get_seq() is None
+    store.set_seq(12)
+    assert store.get_seq() == 12
+
+
+def test_folder(store):
+    assert store.get_folder(u'/') is None
+    store.save_folder(u'/', [FOLDER])
+    assert store.get_folder(u'/') == [FOLDER]
+    assert store.get_folder(u'/docs') is None
+
+
+def test_persistence(store):
+    store.save_folder(u'/', [FOLDER])
+    store.set_seq(3)
+    store.close()
+
+    reloaded = metastore.MetaStore(STORE_PATH)
+    assert reloaded.get_seq() == 3
+    assert reloaded.get_folder(u'/') == [FOLDER]
+    reloaded.close()
+
+
+def test_apply_change(store):
+    store.save_folder(u'/', [FOLDER])
+    store.save_folder(u'/docs', [])
+    store.apply_change({'id': 'file1', 'doc': FILE})
+    assert store.get_folder(u'/docs') == [FILE]
+
+    store.apply_change({'id': 'file1', 'deleted': True})
+    assert store.get_folder(u'/docs') == []
+
+
+def test_apply_change_not_stored(store):
+    store.apply_change({'id': 'file1', 'doc': FILE})
+    assert store.get_folder(u'/docs') is None
+
+
+def test_apply_change_folder_move(store):
+    store.save_folder(u'/', [FOLDER])
+    store.save_folder(u'/docs', [FILE])
+    moved = dict(FOLDER, name='archives')
+    store.apply_change({'id': 'folder1', 'doc': moved})
+    assert store.get_folder(u'/') == [moved]
+    assert store.get_folder(u'/docs') is None
+
+    store.apply_change({'id': 'folder1', 'doc': dict(moved, size=0)})
+    store.save_folder(u'/archives', [])
+    store.apply_change({'id': 'folder1', 'doc': moved})
+    assert store.get_folder(u'/archives') == []
+
+
+def test_accesses(store):
+    store.record_accesses({'file1': (1, 10.), 'file2': (2, 5.)})
+    store.record_accesses({'file1': (2, 20.), 'file3': (1, 30.)})
+    assert store.get_hot_files(2) == ['file1', 'file2']
+    assert store.get_hot_files(5) == ['file1', 'file2', 'file3']
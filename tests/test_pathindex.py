@@ -0,0 +1,192 @@
+import sys
+import os
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+import cozyfuse.pathindex as pathindex
+
+DOCS = [
+    {'_id': 'folder1', 'docType': 'Folder', 'path': '', 'name': 'docs',
+     'lastModification': 'Mon Jan 13 10:00:00 2014'},
+    {'_id': 'file1', 'docType': 'File', 'path': '/docs', 'name': 'a.txt',
+     'size': 12, 'binary': {'file': {'id': 'binary1', 'rev': '1-a'}}},
+    {'_id': 'file2', 'docType': 'File', 'path': '/photos/2014',
+     'name': 'b.jpg', 'size': 42,
+     'binary': {'file': {'id': 'binary2', 'rev': '2-b'}}},
+]
+
+
+def get_index():
+    index = pathindex.PathIndex()
+    for doc in DOCS:
+        index.add_doc(doc)
+    # Without loader, folders are marked loaded on first access.
+    for path in ('/', '/docs', '/photos', '/photos/2014'):
+        index.entries(path)
+    return index
+
+
+def test_lookup():
+    index = get_index()
+    node = index.lookup('/docs/a.txt')
+    assert node.doc_id == 'file1'
+    assert node.size == 12
+    assert node.binary_id == 'binary1'
+    assert node.binary_rev == '1-a'
+    assert index.lookup('/docs').is_folder()
+    assert index.lookup('/docs').mtime == 1389607200
+    assert index.lookup('/docs/missing') is None
+    assert index.lookup('/docs/a.txt/child') is None
+    assert index.lookup('/') is index.root
+
+
+def test_implicit_folders():
+    index = get_index()
+    node = index.lookup('/photos')
+    assert node.is_folder()
+    assert node.doc_id is None
+    assert index.list('/photos/2014') == [u'b.jpg']
+
+
+def test_list():
+    index = get_index()
+    assert sorted(index.list('/')) == [u'docs', u'photos']
+    assert index.list('/docs/a.txt') == []
+
+
+def test_entries():
+    index = get_index()
+    entries = dict(index.entries('/'))
+    assert sorted(entries.keys()) == [u'docs', u'photos']
+    assert entries[u'docs'] is index.lookup('/docs')
+    assert index.entries('/missing') == []
+
+
+def test_remove():
+    index = get_index()
+    index.remove('/photos')
+    assert index.lookup('/photos/2014/b.jpg') is None
+    assert 'file2' not in index.ids
+    assert index.list('/') == [u'docs']
+
+
+def test_move():
+    index = get_index()
+    index.move('/docs', '/archives/docs')
+    node = index.lookup('/archives/docs/a.txt')
+    assert node is index.ids['file1']
+    assert index.get_path(node) == u'/archives/docs/a.txt'
+    assert index.lookup('/docs') is None
+
+
+def test_apply_change_create():
+    index = get_index()
+    index.apply_change({
+        'seq': 12, 'id': 'file3',
+        'doc': {'_id': 'file3', 'docType': 'File', 'path': '/docs',
+                'name': 'c.txt', 'size': 3}
+    })
+    assert index.lookup('/docs/c.txt').doc_id == 'file3'
+    assert index.seq == 12
+
+
+def test_apply_change_move():
+    index = get_index()
+    index.apply_change({
+        'seq': 13, 'id': 'folder1',
+        'doc': {'_id': 'folder1', 'docType': 'Folder', 'path': '/photos',
+                'name': 'texts'}
+    })
+    assert index.lookup('/docs') is None
+    assert index.lookup('/photos/texts/a.txt').doc_id == 'file1'
+
+
+def test_apply_change_delete():
+    index = get_index()
+    index.apply_change({'seq': 14, 'id': 'file1', 'deleted': True,
+                        'doc': {'_id': 'file1', '_deleted': True}})
+    assert index.lookup('/docs/a.txt') is None
+    assert index.lookup('/docs') is not None
+
+
+def test_move_merge():
+    index = get_index()
+    index.add_doc({'_id': 'file3', 'docType': 'File', 'path': '/texts',
+                   'name': 'c.txt'})
+    index.move('/docs', '/texts')
+    assert sorted(index.list('/texts')) == [u'a.txt', u'c.txt']
+
+
+def test_negative_cache():
+    negative = pathindex.NegativeCache(max_size=2, ttl=30)
+    negative.add('/a')
+    negative.add('/b')
+    assert '/a' in negative
+    negative.add('/c')
+    assert '/a' not in negative
+    assert '/c' in negative
+    negative.discard('/c')
+    assert '/c' not in negative
+
+
+def test_negative_cache_ttl():
+    negative = pathindex.NegativeCache(ttl=-1)
+    negative.add('/a')
+    assert '/a' not in negative
+
+
+FOLDER_DOCS = [
+    {'_id': 'folder2', 'docType': 'Folder', 'path': '', 'name': 'photos'},
+    {'_id': 'folder3', 'docType': 'Folder', 'path': '/photos',
+     'name': '2014'},
+]
+
+
+def get_lazy_index(max_size=pathindex.INDEX_SIZE):
+    loads = []
+
+    def loader(path):
+        loads.append(path)
+        for doc in DOCS + FOLDER_DOCS:
+            parent = u'/' + u'/'.join(pathindex._split(doc['path']))
+            if parent == path:
+                yield doc
+
+    return (pathindex.PathIndex(loader, max_size), loads)
+
+
+def test_lazy_loading():
+    (index, loads) = get_lazy_index()
+    assert index.lookup('/docs/a.txt').doc_id == 'file1'
+    assert loads == [u'/', u'/docs']
+    assert index.lookup('/docs/a.txt') is not None
+    assert loads == [u'/', u'/docs']
+    assert index.list('/photos/2014') == [u'b.jpg']
+
+
+def test_lazy_apply_change():
+    (index, loads) = get_lazy_index()
+    index.lookup('/docs')
+    index.apply_change({'id': 'file4', 'seq': 5, 'doc': {
+        '_id': 'file4', 'docType': 'File', 'path': '/photos',
+        'name': 'd.jpg'}})
+    assert index.ids.get('file4') is None
+    assert index.lookup('/photos') is not None
+    assert index.seq == 5
+
+
+def test_lazy_unloading():
+    (index, loads) = get_lazy_index(max_size=4)
+    index.lookup('/docs/a.txt')
+    index.lookup('/photos/2014/b.jpg')
+    assert index.size == 5
+    assert not index.lookup('/docs').loaded
+    assert index.ids.get('file1') is None
+    assert index.lookup('/docs/a.txt').doc_id == 'file1'
@@ -0,0 +1,38 @@
+import sys
+import os
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+import cozyfuse.pins as pins
+
+
+def test_normalize():
+    assert pins.normalize('docs/') == u'/docs'
+    assert pins.normalize(u'/docs//2014') == u'/docs/2014'
+    assert pins.normalize('') == u'/'
+
+
+def test_get_pin():
+    assert pins.get_pin([u'/docs'], u'/docs') == u'/docs'
+    assert pins.get_pin([u'/docs'], u'/docs/2014') == u'/docs'
+    assert pins.get_pin([u'/docs'], u'/docs2') is None
+    assert pins.get_pin([u'/'], u'') == u'/'
+
+
+def test_notify():
+    worker = pins.PinWorker('test-pins', None, None, None)
+    worker.pins = [u'/docs']
+    doc = {'_id': 'file1', 'docType': 'File', 'path': '/docs',
+           'name': 'a.txt', 'binary': {'file': {'id': 'binary1'}}}
+    worker.notify({'id': 'file1', 'doc': doc})
+    worker.notify({'id': 'file1', 'deleted': True})
+    worker.notify({'id': 'file2', 'doc': dict(doc, path='/photos')})
+    assert worker.queue.qsize() == 1
+    assert worker.queue.get() == doc
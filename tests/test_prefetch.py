@@ -0,0 +1,76 @@
+import sys
+import os
+import time
+import threading
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+import cozyfuse.prefetch as prefetch
+from cozyfuse.cache import CacheHandle
+
+
+def test_first_read_no_prefetch():
+    readahead = prefetch.ReadAhead(4, max_window=8)
+    assert readahead.access(0, 4) == []
+
+
+def test_window_grows():
+    readahead = prefetch.ReadAhead(4, max_window=4)
+    readahead.access(0, 4)
+    assert readahead.access(4, 4) == [2]
+    assert readahead.access(8, 4) == [3, 4]
+    assert readahead.access(12, 4) == [5, 6, 7]
+    assert readahead.access(16, 4) == [8]
+    assert readahead.window == 4
+
+
+def test_window_collapses_on_seek():
+    readahead = prefetch.ReadAhead(4, max_window=4)
+    readahead.access(0, 4)
+    readahead.access(4, 4)
+    readahead.access(8, 4)
+    assert readahead.access(100, 4) == []
+    assert readahead.window == 0
+    assert readahead.access(104, 4) == [27]
+
+
+def test_window_bounded_by_length():
+    readahead = prefetch.ReadAhead(4, max_window=8)
+    readahead.access(0, 4)
+    readahead.access(4, 4)
+    assert readahead.access(8, 4, length=14) == [3]
+    assert readahead.access(12, 2, length=14) == []
+
+
+def test_prefetcher():
+    fetched = []
+    done = threading.Event()
+
+    def fetch(cache_handle, index):
+        fetched.append((cache_handle.binary_id, index))
+        if len(fetched) == 3:
+            done.set()
+
+    prefetcher = prefetch.Prefetcher(fetch, workers=1)
+    prefetcher.start()
+    handle = CacheHandle(None, 'binary', '1-a')
+    prefetcher.schedule(handle, [1, 2, 3])
+    done.wait(5)
+    prefetcher.stop()
+
+    assert sorted(fetched) == [('binary', 1), ('binary', 2), ('binary', 3)]
+    time.sleep(0.1)
+    assert len(prefetcher.pending) == 0
+
+
+def test_prefetcher_not_started():
+    prefetcher = prefetch.Prefetcher(None)
+    prefetcher.schedule(CacheHandle(None, 'binary', '1-a'), [1])
+    assert prefetcher.queue.empty()
@@ -0,0 +1,97 @@
+import sys
+import os
+import shutil
+import pytest
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+import cozyfuse.staging as staging
+
+STAGING_FOLDER = os.path.join(local_config.CONFIG_FOLDER, 'staging-test')
+
+
+@pytest.fixture
+def staged(request):
+    if not os.path.isdir(STAGING_FOLDER):
+        os.makedirs(STAGING_FOLDER)
+    staged = staging.StagingFile(STAGING_FOLDER)
+
+    def fin():
+        staged.remove()
+        shutil.rmtree(STAGING_FOLDER)
+    request.addfinalizer(fin)
+
+    return staged
+
+
+def test_write_at_offset(staged):
+    staged.write('world', 6)
+    staged.write('hello ', 0)
+    assert staged.size == 11
+    assert staged.read(11, 0) == 'hello world'
+
+
+def test_write_hole(staged):
+    staged.write('end', 4)
+    assert staged.read(7, 0) == '\0\0\0\0end'
+
+
+def test_truncate(staged):
+    staged.write('hello world', 0)
+    staged.truncate(5)
+    assert staged.size == 5
+    assert staged.read(100, 0) == 'hello'
+    assert staged.read(10, 5) == ''
+
+
+def test_clear_folder(staged):
+    staging.clear_folder(STAGING_FOLDER)
+    assert not os.path.isfile(staged.path)
+
+
+def test_stream(staged):
+    staged.write('a' * 10, 0)
+    stream = staged.stream()
+    stream.chunk_size = 4
+    assert stream.read() == 'aaaa'
+    assert stream.read(2) == 'aa'
+    assert stream.progress() == 60
+    assert stream.read(8) == 'aaaa'
+    assert stream.read() == ''
+    assert stream.sent == 10
+    stream.close()
+
+
+def test_dirty(staged):
+    assert not staged.dirty
+    staged.write('hello', 0)
+    assert staged.dirty
+
+
+def test_digest(staged):
+    staged.write('hello', 0)
+    assert staged.digest() == 'md5-XUFAKrxLKna5cZ2REBfFkg=='
+
+
+def test_move(staged):
+    staged.write('content', 0)
+    path = os.path.join(STAGING_FOLDER, 'moved')
+    staged.move(path)
+    assert staged.path == path
+    assert staged.file.closed
+    with open(path) as moved:
+        assert moved.read() == 'content'
+
+
+def test_sync(staged):
+    staged.write('content', 0)
+    staged.sync()
+    with open(staged.path) as synced:
+        assert synced.read() == 'content'
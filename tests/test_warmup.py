@@ -0,0 +1,60 @@
+import sys
+import os
+import time
+import threading
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+import cozyfuse.warmup as warmup
+
+
+class StoreStub(object):
+
+    def __init__(self):
+        self.accesses = []
+
+    def record_accesses(self, accesses):
+        self.accesses.append(accesses)
+
+
+def test_access_log():
+    access_log = warmup.AccessLog()
+    access_log.record('file1')
+    access_log.record('file1')
+    access_log.record('file2')
+
+    store = StoreStub()
+    access_log.flush(store)
+    access_log.flush(store)
+    assert len(store.accesses) == 1
+    assert store.accesses[0]['file1'][0] == 2
+    assert store.accesses[0]['file2'][0] == 1
+
+
+def test_foreground_gate():
+    gate = warmup.ForegroundGate(idle_delay=0.1)
+    gate.wait_idle()
+
+    gate.enter()
+    released = []
+
+    def wait():
+        gate.wait_idle()
+        released.append(time.time())
+    thread = threading.Thread(target=wait)
+    thread.start()
+    time.sleep(0.2)
+    assert released == []
+
+    left = time.time()
+    gate.leave()
+    thread.join(2)
+    assert len(released) == 1
+    assert released[0] - left >= 0.09
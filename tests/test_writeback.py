@@ -0,0 +1,130 @@
+import sys
+import os
+import time
+import shutil
+import threading
+import pytest
+
+sys.path.append('..')
+
+import cozyfuse.local_config as local_config
+local_config.CONFIG_FOLDER = \
+    os.path.join(os.path.expanduser('~'), '.cozyfuse-test')
+
+local_config.CONFIG_PATH = \
+    os.path.join(local_config.CONFIG_FOLDER, 'config.yaml')
+
+import cozyfuse.staging as staging
+import cozyfuse.writeback as writeback
+
+STAGING_FOLDER = os.path.join(local_config.CONFIG_FOLDER, 'staging-test')
+QUEUE_FOLDER = os.path.join(local_config.CONFIG_FOLDER, 'writeback-test')
+
+
+@pytest.fixture
+def queue(request):
+    for folder in (STAGING_FOLDER, QUEUE_FOLDER):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def fin():
+        shutil.rmtree(STAGING_FOLDER)
+        shutil.rmtree(QUEUE_FOLDER)
+    request.addfinalizer(fin)
+    return writeback.WriteBackQueue(QUEUE_FOLDER)
+
+
+def stage(content):
+    staged = staging.StagingFile(STAGING_FOLDER)
+    staged.write(content, 0)
+    return staged
+
+
+def test_push(queue):
+    staged = stage('content')
+    queue.push('file1', 'binary1', u'/file1', staged)
+    assert staged.path.startswith(QUEUE_FOLDER)
+    assert os.listdir(STAGING_FOLDER) == []
+    assert queue.get_content('file1').read(7, 0) == 'content'
+    assert queue.get_content('file2') is None
+
+    stats = queue.stats()
+    assert stats['depth'] == 1
+    assert stats['bytes'] == 7
+
+
+def get_open_queue_files():
+    paths = []
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            paths.append(os.readlink(os.path.join('/proc/self/fd', fd)))
+        except OSError:
+            pass
+    return [path for path in paths if path.startswith(QUEUE_FOLDER)]
+
+
+def test_no_open_files(queue):
+    for number in range(20):
+        queue.push('file%d' % number, 'binary', u'/file', stage('content'))
+    assert get_open_queue_files() == []
+
+    reloaded = writeback.WriteBackQueue(QUEUE_FOLDER)
+    assert reloaded.stats()['depth'] == 20
+    assert get_open_queue_files() == []
+
+
+def test_coalesce(queue):
+    first = queue.push('file1', 'binary1', u'/file1', stage('first'))
+    second = queue.push('file1', 'binary1', u'/file1', stage('second'))
+    assert queue.stats()['depth'] == 1
+    assert second.queued == first.queued
+    assert queue.next() is second
+    assert first.content.read(5, 0) is None
+    assert second.content.read(6, 0) == 'second'
+
+    # Upload of the replaced entry does not remove the new one.
+    queue.complete(first)
+    assert queue.is_queued(second)
+    queue.complete(second)
+    assert queue.stats()['depth'] == 0
+    assert os.listdir(QUEUE_FOLDER) == []
+
+
+def test_reload(queue):
+    queue.push('file1', 'binary1', u'/file1', stage('content'))
+    queue.push('file2', 'binary2', u'/file2', stage('other'))
+    queue.discard('file2')
+    with open(os.path.join(QUEUE_FOLDER, 'orphan.staging'), 'w') as orphan:
+        orphan.write('interrupted save')
+
+    reloaded = writeback.WriteBackQueue(QUEUE_FOLDER)
+    entry = reloaded.next()
+    assert entry.doc_id == 'file1'
+    assert entry.path == u'/file1'
+    assert entry.content.read(7, 0) == 'content'
+    assert reloaded.stats()['depth'] == 1
+    assert len(os.listdir(QUEUE_FOLDER)) == 2
+    assert writeback.read_status(QUEUE_FOLDER)['depth'] == 1
+
+
+def test_uploader(queue):
+    uploaded = []
+    done = threading.Event()
+
+    def upload(entry):
+        if len(uploaded) == 0:
+            uploaded.append(None)
+            raise IOError('Network is down')
+        uploaded.append(entry.content.read(7, 0))
+        done.set()
+
+    writeback.RETRY_DELAY = 0
+    uploader = writeback.Uploader(queue, upload)
+    uploader.start()
+    queue.push('file1', 'binary1', u'/file1', stage('content'))
+    assert done.wait(5)
+    uploader.stop()
+    uploader.join(5)
+
+    assert uploaded == [None, 'content']
+    assert queue.stats()['depth'] == 0